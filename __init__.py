@@ -31,3 +31,5 @@ import wadio
 import wad
 import lump
 import mapedit
+import overlay
+import diskcache
@@ -0,0 +1,108 @@
+"""
+    Asynchronous lump reading for asyncio programs. Lumps are read
+    from a read-only WadIO object by a pool of worker threads, so the
+    event loop is never blocked by file access.
+
+    asyncio is part of Python 3.4 and later; on Python 2, the trollius
+    backport (and the futures backport) can be used instead.
+"""
+
+import functools
+
+try:
+    import asyncio
+except ImportError:
+    import trollius as asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from omg.wadio import WadIO
+
+class AsyncWadIO:
+    """Reads lumps from a WAD file without blocking the event loop.
+
+    Initialization:
+    a = AsyncWadIO(source[, max_workers])
+
+    Source may be a path to a WAD file or a WadIO object, which must
+    have been opened with readonly=True so that it can be read from
+    several threads at once; ValueError is raised otherwise. At most
+    `max_workers` threads read from the file at a time.
+
+    aread() looks entries up just like WadIO.select and returns a
+    future for the data, so it is used as follows:
+
+        data = await a.aread('E1M1')
+
+    All requests made before the event loop gets to run again are
+    combined into a single batch, which is read in one pass over the
+    file, sorted by position."""
+
+    def __init__(self, source, max_workers=4, loop=None):
+        if isinstance(source, WadIO):
+            if not source.readonly:
+                raise ValueError, "the WadIO object must be read-only"
+            self.wadio = source
+            self._own = False
+        else:
+            self.wadio = WadIO(source, readonly=True)
+            self._own = True
+        self.executor = ThreadPoolExecutor(max_workers)
+        self.loop = loop
+        self._queue = []
+
+    def aread(self, id):
+        """Return a future for the data of an entry, given its index or
+        name (wildcards are supported). Raises LookupError immediately
+        if there is no such entry."""
+        index = self.wadio.select(id)
+        loop = self.loop or asyncio.get_event_loop()
+        if hasattr(loop, 'create_future'):
+            future = loop.create_future()
+        else:
+            future = asyncio.Future(loop=loop)
+        if not self._queue:
+            loop.call_soon(self._dispatch, loop)
+        self._queue.append((index, future))
+        return future
+
+    def aread_many(self, ids):
+        """Return a future for a list with the data of several entries.
+        The entries are read in one batch."""
+        return asyncio.gather(*[self.aread(id) for id in ids])
+
+    def _dispatch(self, loop):
+        """Hand all queued requests to a worker thread as a batch."""
+        batch, self._queue = self._queue, []
+        batch.sort(key=lambda request: self.wadio._extent(request[0])[0])
+        job = loop.run_in_executor(self.executor, self._read_batch,
+            [index for index, future in batch])
+        job.add_done_callback(functools.partial(self._deliver, batch))
+
+    def _read_batch(self, indices):
+        return [self.wadio.read(i) for i in indices]
+
+    def _deliver(self, batch, job):
+        if job.cancelled() or job.exception() is not None:
+            for index, future in batch:
+                if not future.done():
+                    if job.cancelled():
+                        future.cancel()
+                    else:
+                        future.set_exception(job.exception())
+            return
+        for (index, future), data in zip(batch, job.result()):
+            if not future.done():
+                future.set_result(data)
+
+    def close(self):
+        """Stop the worker threads, and close the WAD file if it was
+        opened by this object."""
+        self.executor.shutdown()
+        if self._own:
+            self.wadio.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -8,12 +8,11 @@ if (len(sys.argv) < 3):
     print "    merge.py input1.wad input2.wad ... [-o output.wad]\n"
     print "    Default output is merged.wad"
 else:
-    w = wad.WAD()
-    for a in sys.argv[1:]:
-        if a == "-o":
-            break
-        print "Adding %s..." % a
-        w += wad.WAD(a)
+    inputs = sys.argv[1:]
     outpath = "merged.wad"
-    if "-o" in sys.argv: outpath = sys.argv[-1]
-    w.to_file(outpath)
+    if "-o" in inputs:
+        outpath = inputs[inputs.index("-o") + 1]
+        inputs = inputs[:inputs.index("-o")]
+    for a in inputs:
+        print "Adding %s..." % a
+    wad.merge(inputs, outpath)
@@ -7,14 +7,7 @@ from omg import wad, mapedit, util
 
 def mirror(map):
     ed = mapedit.MapEditor(map)
-    for v in ed.vertexes:
-        v.x = -v.x
-    for l in ed.linedefs:
-        l.vx_a, l.vx_b = l.vx_b, l.vx_a
-    for t in ed.things:
-        t.x = -t.x
-        t.angle = (180 - t.angle) % 360
-    ed.nodes.data = ""
+    ed.mirror()
     return ed.to_lumps()
 
 def main(args):
@@ -24,7 +17,7 @@ def main(args):
         print "    mirror.py input.wad output.wad [pattern]\n"
         print "    Mirror all maps or those whose name match the given pattern"
         print "    (eg E?M4 or MAP*)."
-        print "    Note: nodes will have to be rebuilt externally.\n"
+        print "    Note: the blockmap will have to be rebuilt externally.\n"
     else:
         print "Loading %s..." % args[0]
         inwad = wad.WAD()
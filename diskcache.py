@@ -0,0 +1,122 @@
+"""
+    Persistent cache of data parsed from WAD files, so that opening
+    the same files again and again doesn't mean parsing them again.
+"""
+
+import os, hashlib, tempfile
+import cPickle as pickle
+
+import omg
+from omg import wad, mapedit, txdef, playpal
+
+# Stored with every entry, so that entries made by another version of
+# the library (whose classes may have changed) are rebuilt. Increase
+# _FORMAT when the pickled classes change between releases.
+_FORMAT = 1
+_VERSION = (omg.__version__, _FORMAT)
+
+class DiskCache:
+    """Keeps data parsed from WAD files in a directory.
+
+    Initialization:
+    c = DiskCache(directory)
+
+    Every entry belongs to a WAD file and is identified by the file's
+    absolute path, size and modification time, so when the file
+    changes, its entries are rebuilt automatically. Entries are
+    stored with pickle, one file per entry, and written atomically.
+    Entries made by another version of the library, or unreadable
+    ones, are rebuilt as well.
+
+    The wad(), map(), textures() and playpal() methods return the
+    parsed data for a file, from the cache if possible; get() caches
+    anything else.
+
+    Member data:
+        .directory    Where the cache is stored
+        .hits         Number of entries found in the cache
+        .misses       Number of entries that had to be built"""
+
+    def __init__(self, directory):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.hits = self.misses = 0
+
+    def identity(self, path):
+        """Return the (path, size, modification time) tuple that the
+        entries for a file are keyed by."""
+        st = os.stat(path)
+        return os.path.abspath(path), st.st_size, st.st_mtime
+
+    def _entry_path(self, path, key):
+        # Entries made by other versions are kept under other names
+        name = hashlib.sha1(repr((_VERSION, os.path.abspath(path),
+            key))).hexdigest()
+        return os.path.join(self.directory, name + ".pickle")
+
+    def get(self, path, key, build):
+        """Return the data for a WAD file named by `key` (any value with
+        a stable repr). If the cache has no valid entry for it, call
+        build() to make the data, store it and return it."""
+        identity = self.identity(path)
+        entry_path = self._entry_path(path, key)
+        try:
+            f = open(entry_path, 'rb')
+            try:
+                # The key comes first, so that the value is only
+                # unpickled if it was made by this version
+                if pickle.load(f) == (_VERSION, identity, key):
+                    value = pickle.load(f)
+                    self.hits += 1
+                    return value
+            finally:
+                f.close()
+        except (IOError, OSError, EOFError, ValueError, IndexError,
+                KeyError, pickle.UnpicklingError):
+            # Missing or damaged; build it again
+            pass
+        self.misses += 1
+        value = build()
+        fd, tmppath = tempfile.mkstemp(dir=self.directory)
+        f = os.fdopen(fd, 'wb')
+        try:
+            pickle.dump((_VERSION, identity, key), f,
+                pickle.HIGHEST_PROTOCOL)
+            pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        os.rename(tmppath, entry_path)
+        return value
+
+    def wad(self, path, structure=wad.defstruct, lazy=True):
+        """Load a WAD object, lazily by default, skipping the
+        classification of lumps if it is cached."""
+        return wad.WAD(path, structure, lazy, parse_cache=self)
+
+    def map(self, path, name):
+        """Return a MapEditor for a map in a WAD file, with all its
+        record lists decoded."""
+        def build():
+            editor = mapedit.MapEditor(self.wad(path).maps[name])
+            editor.decode()
+            return editor
+        return self.get(path, ('map', name), build)
+
+    def textures(self, path):
+        """Return the texture definitions in a WAD file as a
+        txdef.Textures object."""
+        return self.get(path, ('textures',),
+            lambda: txdef.Textures(self.wad(path).txdefs))
+
+    def playpal(self, path):
+        """Return a playpal.Playpal object for the PLAYPAL lump in a
+        WAD file."""
+        return self.get(path, ('playpal',),
+            lambda: playpal.Playpal(self.wad(path).data['PLAYPAL']))
+
+    def clear(self):
+        """Remove all entries."""
+        for name in os.listdir(self.directory):
+            if name.endswith(".pickle"):
+                os.remove(os.path.join(self.directory, name))
@@ -11,21 +11,97 @@ except:
     except:
         pass
 
-import os
+import os, collections
 from omg import palette, util
 
+class LumpCache:
+    """Limits the memory used by the data of lumps loaded from files.
+
+    Lumps that are attached to a cache (by setting their ._cache
+    attribute) report each access to their data. Once the data of the
+    unchanged lumps exceeds max_resident_bytes, the least recently used
+    is dropped from memory; it is read from the file again when next
+    needed. Lumps whose data has been changed are not tracked and stay
+    in memory.
+
+    Member data:
+        .max_resident_bytes   The budget
+        .resident_bytes       Size of the data of tracked lumps
+        .hits                 Accesses to data already in memory
+        .misses               Accesses that read data from a file
+        .evictions            Number of times data was dropped"""
+
+    def __init__(self, max_resident_bytes):
+        self.max_resident_bytes = max_resident_bytes
+        self.resident_bytes = 0
+        self.hits = self.misses = self.evictions = 0
+        # id(lump) -> (lump, size), least recently used first
+        self._lru = collections.OrderedDict()
+
+    def add(self, lump):
+        """Start tracking the data of a lump, or mark it as the most
+        recently used."""
+        key = id(lump)
+        entry = self._lru.pop(key, None)
+        if entry is None:
+            entry = (lump, len(lump._data))
+            self.resident_bytes += entry[1]
+        self._lru[key] = entry
+        # The most recently used lump is always kept
+        while self.resident_bytes > self.max_resident_bytes and \
+                len(self._lru) > 1:
+            key, (old, size) = self._lru.popitem(last=False)
+            self.resident_bytes -= size
+            old._data = None
+            self.evictions += 1
+
+    def access(self, lump, hit):
+        """Record an access to the data of a lump."""
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        self.add(lump)
+
+    def discard(self, lump):
+        """Stop tracking the data of a lump."""
+        entry = self._lru.pop(id(lump), None)
+        if entry is not None:
+            self.resident_bytes -= entry[1]
+
+    def clear(self):
+        """Drop the data of all tracked lumps from memory."""
+        for lump, size in self._lru.itervalues():
+            lump._data = None
+            self.evictions += 1
+        self._lru.clear()
+        self.resident_bytes = 0
+
 class Lump(object):
     """Basic lump class. Instances of Lump (and its subclasses)
     always have the following:
 
         .data       -- a string holding the lump's data
+        .size       -- the size of the data
+        .origin     -- where the data was loaded from, see below
         .from_file  -- load the data to a file
         .to_file    -- save the data to a file
 
     The default Lump class merely copies the raw data when
     loading/saving to files, but subclasses may convert data
     appropriately (for example, Graphic supports various image
-    formats)."""
+    formats).
+
+    Lumps that belong to a WAD with a memory budget are attached to a
+    LumpCache, which may drop unchanged data from memory.
+
+    A lump loaded from a WAD file remembers where its data is found
+    in the file as a (WadIO object, position, size) tuple in .origin,
+    until the data is changed; then .origin is None. (Once the data
+    is read, the WadIO object may have been closed.) A lump may also
+    be loaded lazily, in which case nothing is read from the file until
+    .data is first accessed. The file must stay open and unchanged in
+    the meantime."""
 
     def __init__(self, data=None, from_file=None):
         """Create a new instance. The `data` parameter may be a string
@@ -33,12 +109,66 @@ class Lump(object):
         a path to a file or a file-like object to load from."""
         self.data = ""
         if issubclass(type(data), Lump):
-            self.data = data.data
+            # Don't force a lazy lump to be read
+            self._data = data._data
+            self.origin = data.origin
         elif data is not None:
             self.data = data or ""
         if from_file:
             self.from_file(from_file)
 
+    _cache = None
+
+    def get_data(self):
+        data = self._data
+        if data is None:
+            wadio, ptr, size = self.origin
+            self._data = data = wadio.read_at(ptr, size)
+            if self._cache is not None:
+                self._cache.access(self, False)
+        elif self._cache is not None and self.origin is not None:
+            self._cache.access(self, True)
+        return data
+
+    def set_data(self, data):
+        if self._cache is not None:
+            self._cache.discard(self)
+        self._data = data
+        self.origin = None
+
+    data = property(get_data, set_data)
+
+    def get_size(self):
+        """Retrieve the size of the data, without reading it."""
+        if self._data is None:
+            return self.origin[2]
+        return len(self._data)
+
+    size = property(get_size)
+
+    def __copy__(self):
+        # Keep the origin (and any cache), unlike pickling
+        c = self.__class__.__new__(self.__class__)
+        c.__dict__.update(self.__dict__)
+        return c
+
+    def __getstate__(self):
+        # The origin refers to an open file, so pickle the data instead
+        state = self.__dict__.copy()
+        state['_data'] = self.data
+        state['origin'] = None
+        state.pop('_cache', None)
+        return state
+
+    def from_wadio(self, wadio, ptr, size, lazy=False):
+        """Take the data at a position in a file opened as a WadIO
+        object. If `lazy` is set, the data is not read until needed."""
+        if lazy:
+            self._data = None
+        else:
+            self._data = wadio.read_at(ptr, size)
+        self.origin = (wadio, ptr, size)
+
     def from_file(self, source):
         """Load data from a file. Source may be a path name string
         or a file-like object (with a `write` method)."""
@@ -50,7 +180,15 @@ class Lump(object):
         util.writefile(target, self.data)
 
     def copy(self):
-        return util.deepcopy(self)
+        """Create a copy of the lump. The copy shares its data with the
+        original, which is safe since the data is replaced rather than
+        modified when a lump changes; only the one changed stops
+        sharing."""
+        c = util.copy(self)
+        if self._data is not None and not isinstance(self._data, str):
+            # Mutable data (e.g. a bytearray) can't be shared
+            c._data = self._data[:]
+        return c
 
 
 class Music(Lump):
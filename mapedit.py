@@ -1,3 +1,10 @@
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 from omg import util, lump
 from omg.wad import NameGroup
 
@@ -83,6 +90,454 @@ GLSeg = util.make_struct(
    ["partner", 'h', 0]]
 )
 
+Node = util.make_struct(
+  "Node", """Represents a map BSP node""",
+  [["x",        'h', 0],
+   ["y",        'h', 0],
+   ["dx",       'h', 0],
+   ["dy",       'h', 0],
+   ["r_top",    'h', 0],
+   ["r_bottom", 'h', 0],
+   ["r_left",   'h', 0],
+   ["r_right",  'h', 0],
+   ["l_top",    'h', 0],
+   ["l_bottom", 'h', 0],
+   ["l_left",   'h', 0],
+   ["l_right",  'h', 0],
+   ["right",    'H', 0],
+   ["left",     'H', 0]]
+)
+
+
+#----------------------------------------------------------------------
+#
+# Lists of records that keep track of changes, so that only what has
+# changed is packed again
+#
+
+def _tracked_setattr(self, name, value):
+    object.__setattr__(self, name, value)
+    self._owner._changed_rows.add(self._row)
+
+def _tracked_reduce_ex(self, protocol):
+    # Copies and pickles are plain records
+    return _plain_record, (type(self).__bases__[0], self.__getstate__())
+
+def _plain_record(class_, state):
+    record = class_.__new__(class_)
+    record.__setstate__(state)
+    return record
+
+class RecordList(list):
+    """A list of map records of one class, decoded from a lump. It
+    keeps track of what changes, so that tobytes() only packs changed
+    records and copies the rest from the decoded data.
+
+    Initialization:
+    r = RecordList(class_, [data])
+
+    The records decoded from the data report changes to their fields
+    by the position they were decoded at; they belong to a subclass of
+    the record class made for the list (copies of them are plain
+    records). Changes to the list itself count from the first position
+    they affect, and everything from there on is packed again.
+
+    Member data:
+        .record_class  The record class (Vertex, Linedef, etc)
+        .source        The lump the records were decoded from, if any
+
+    A RecordList is pickled and copied as a plain list."""
+
+    source = None
+
+    def __init__(self, class_, data=""):
+        tracked = type(class_.__name__, (class_,), {'__slots__': ('_row',),
+            '__reduce_ex__': _tracked_reduce_ex, '_owner': self})
+        list.__init__(self, tracked.unpack_many(data))
+        for row, record in enumerate(self):
+            record._row = row
+        # Changes are reported from now on
+        tracked.__setattr__ = _tracked_setattr
+        self.record_class = class_
+        self._packed = data
+        self._count = len(self)
+        # Positions from here on have to be packed again
+        self._point = self._count
+        # Positions below the point whose records have changed
+        self._changed_rows = set()
+
+    def _moved(self, index):
+        """Note that the records from a position on may have moved"""
+        self._point = max(0, min(self._point, index))
+
+    def _position(self, index):
+        if index < 0:
+            index += len(self)
+        return max(0, min(index, len(self)))
+
+    def changed(self):
+        """Return True if anything changed since decoding."""
+        return bool(self._point != self._count or len(self) != self._count
+            or self._changed_rows)
+
+    def tobytes(self):
+        """Return the records packed into a string"""
+        size = self.record_class._fmtsize
+        point = min(self._point, len(self))
+        # Below the point, every position not assigned to still holds
+        # the record decoded there, so rows name the changed records
+        rows = [i for i in self._changed_rows if i < point]
+        if len(rows) > point // 8:
+            # Packing everything is faster once many records changed
+            return self.record_class.pack_many(self)
+        parts = []
+        pos = 0
+        for i in sorted(rows):
+            parts.append(self._packed[pos*size:i*size])
+            parts.append(self[i].pack())
+            pos = i + 1
+        parts.append(self._packed[pos*size:point*size])
+        parts.append(self.record_class.pack_many(self[point:]))
+        return "".join(parts)
+
+    def __reduce__(self):
+        return list, (list(self),)
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            self._moved(min(xrange(*index.indices(len(self))) or [len(self)]))
+            list.__setitem__(self, index, value)
+        else:
+            list.__setitem__(self, index, value)
+            self._changed_rows.add(self._position(index))
+
+    def __setslice__(self, i, j, sequence):
+        self._moved(i)
+        list.__setslice__(self, i, j, sequence)
+
+    def __delitem__(self, index):
+        if isinstance(index, slice):
+            self._moved(min(xrange(*index.indices(len(self))) or [len(self)]))
+        else:
+            self._moved(self._position(index))
+        list.__delitem__(self, index)
+
+    def __delslice__(self, i, j):
+        self._moved(i)
+        list.__delslice__(self, i, j)
+
+    def __iadd__(self, sequence):
+        self._moved(len(self))
+        return list.__iadd__(self, sequence)
+
+    def __imul__(self, n):
+        self._moved(n > 0 and len(self) or 0)
+        return list.__imul__(self, n)
+
+    def append(self, record):
+        self._moved(len(self))
+        list.append(self, record)
+
+    def extend(self, records):
+        self._moved(len(self))
+        list.extend(self, records)
+
+    def insert(self, index, record):
+        self._moved(self._position(index))
+        list.insert(self, index, record)
+
+    def pop(self, index=-1):
+        self._moved(self._position(index))
+        return list.pop(self, index)
+
+    def remove(self, record):
+        del self[self.index(record)]
+
+    def reverse(self):
+        self._moved(0)
+        list.reverse(self)
+
+    def sort(self, *args, **kwargs):
+        self._moved(0)
+        list.sort(self, *args, **kwargs)
+
+
+#----------------------------------------------------------------------
+#
+# Columnar storage of map records in NumPy structured arrays
+#
+
+# NumPy types for the struct format codes used by the record classes
+_dtype_codes = {'b': 'i1', 'B': 'u1', 'h': 'i2', 'H': 'u2',
+                'i': 'i4', 'I': 'u4', 'l': 'i4', 'L': 'u4'}
+
+def _dtype(class_):
+    """Return a NumPy dtype with the binary layout of a record class"""
+    fields = []
+    for name, fmt in class_._fields:
+        if fmt.endswith('s'):
+            fields.append((name, 'S' + fmt[:-1]))
+        else:
+            fields.append((name, '<' + _dtype_codes[fmt]))
+    return numpy.dtype(fields)
+
+def _column_property(name, string):
+    """Property for a row attribute that reads and writes a column"""
+    if string:
+        def get(self):
+            return util.fixname(self._records._data[name][self._index][:8])
+        def set(self, value):
+            self._records._data[name][self._index] = util.safe_name(value)
+            self._records._changed = True
+    else:
+        def get(self):
+            return int(self._records._data[name][self._index])
+        def set(self, value):
+            self._records._data[name][self._index] = value
+            self._records._changed = True
+    return property(get, set)
+
+class Row(object):
+    """A record in a Records array. Has the attributes (including flag
+    properties) of the record class, which read and write the array
+    in place. Copying a row gives an independent record object."""
+
+    __slots__ = ('_records', '_index')
+
+    def __init__(self, records, index):
+        self._records = records
+        self._index = index
+
+    def record(self):
+        """Return a record object with the values of this row."""
+        return self._class(**dict((name, getattr(self, name)) \
+            for name, fmt in self._class._fields))
+
+    def __copy__(self):
+        return self.record()
+
+    def __deepcopy__(self, memo):
+        return self.record()
+
+    def pack(self):
+        return self._records._data[self._index].tobytes()
+
+    def __repr__(self):
+        return repr(self.record())
+
+_row_classes = {}
+
+def _row_class(class_):
+    """Return the Row subclass for a record class"""
+    try:
+        return _row_classes[class_]
+    except KeyError:
+        pass
+    attrs = {'__slots__': (), '_class': class_}
+    for name, fmt in class_._fields:
+        attrs[name] = _column_property(name, fmt.endswith('s'))
+    # Flag properties work on top of the flags column
+    for name, value in vars(class_).items():
+        if isinstance(value, property):
+            attrs[name] = value
+    row = type(class_.__name__ + "Row", (Row,), attrs)
+    _row_classes[class_] = row
+    return row
+
+class Records(object):
+    """A list of map records of one class, kept in a NumPy structured
+    array with the same binary layout as the lump, so that a lump is
+    decoded and encoded as a whole.
+
+    Initialization:
+    r = Records(class_, [data])
+
+    Indexing gives Row objects. A row refers to a position in the
+    array, not to a record, so after deleting rows it shows whatever
+    has moved into its place. Anything with the attributes of the
+    record class (a record object or a row) can be assigned, appended
+    or inserted.
+
+    Member data:
+        .record_class  The record class (Vertex, Linedef, etc)
+        .array         The structured array, one element per record
+        .source        The lump the records were decoded from, if any
+
+    Getting .array counts as a change, since the array can be changed
+    through it."""
+
+    source = None
+    _changed = False
+
+    def __init__(self, class_, data=""):
+        dtype = _dtype(class_)
+        self.record_class = class_
+        self._data = numpy.frombuffer(data, dtype,
+            len(data) // dtype.itemsize).copy()
+        self._len = len(self._data)
+
+    def get_array(self):
+        self._changed = True
+        return self._data[:self._len]
+    def set_array(self, array):
+        self._data = numpy.array(array, self._data.dtype)
+        self._len = len(self._data)
+        self._changed = True
+    array = property(get_array, set_array)
+
+    def _reserve(self, count):
+        """Make room for appending count rows"""
+        if self._len + count > len(self._data):
+            data = numpy.zeros(max(self._len + count, 2*self._len, 16),
+                self._data.dtype)
+            data[:self._len] = self._data[:self._len]
+            self._data = data
+
+    def _values(self, record):
+        """Tuple of the field values of a record in array form"""
+        values = []
+        for name, fmt in self.record_class._fields:
+            value = getattr(record, name)
+            if fmt.endswith('s'):
+                value = util.safe_name(value)
+            values.append(value)
+        return tuple(values)
+
+    def _position(self, index):
+        if index < 0:
+            index += self._len
+        if not 0 <= index < self._len:
+            raise IndexError, "Records index out of range"
+        return index
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(self._len))]
+        return _row_class(self.record_class)(self, self._position(index))
+
+    def __setitem__(self, index, record):
+        self._data[self._position(index)] = self._values(record)
+        self._changed = True
+
+    def __delitem__(self, index):
+        if not isinstance(index, slice):
+            index = self._position(index)
+        self.array = numpy.delete(self.array, index, 0)
+
+    def __iter__(self):
+        row = _row_class(self.record_class)
+        for i in xrange(self._len):
+            yield row(self, i)
+
+    def append(self, record):
+        self._reserve(1)
+        self._data[self._len] = self._values(record)
+        self._len += 1
+        self._changed = True
+
+    def extend(self, records):
+        if isinstance(records, Records) and \
+                records.record_class is self.record_class:
+            self._reserve(len(records))
+            self._data[self._len:self._len+len(records)] = \
+                records._data[:len(records)]
+            self._len += len(records)
+            self._changed = True
+        else:
+            for record in records:
+                self.append(record)
+
+    def insert(self, index, record):
+        if index < 0:
+            index = max(0, index + self._len)
+        index = min(index, self._len)
+        self.array = numpy.insert(self.array, index,
+            numpy.array(self._values(record), self._data.dtype), 0)
+
+    def changed(self):
+        """Return True if anything changed since decoding."""
+        return self._changed
+
+    def tobytes(self):
+        """Return the records packed into a string"""
+        return self._data[:self._len].tobytes()
+
+    def __getstate__(self):
+        return {'record_class': self.record_class,
+            '_data': self._data[:self._len], '_len': self._len}
+
+
+#----------------------------------------------------------------------
+#
+# Bulk updates of record fields, used by the geometry transformations
+#
+# Fields are computed from whole columns at once with NumPy when it is
+# available, otherwise record by record with the same code.
+#
+
+if numpy is not None:
+    _floor, _atan2, _hypot = numpy.floor, numpy.arctan2, numpy.hypot
+    _cos, _sin, _where = numpy.cos, numpy.sin, numpy.where
+    _maximum, _minimum = numpy.maximum, numpy.minimum
+else:
+    _floor, _atan2, _hypot = math.floor, math.atan2, math.hypot
+    _cos, _sin = math.cos, math.sin
+    _where = lambda condition, a, b: a if condition else b
+    _maximum, _minimum = max, min
+
+def _round(values):
+    return _floor(values + 0.5)
+
+def _column(records, name):
+    """Return the values of a field of all records, for indexing"""
+    if isinstance(records, Records):
+        return records._data[:len(records)][name].astype(numpy.int64)
+    values = [getattr(r, name) for r in records]
+    if numpy is not None:
+        return numpy.array(values, numpy.int64)
+    return values
+
+# Ranges of the integer struct format codes
+_limits = {'b': (-1<<7, (1<<7)-1),   'B': (0, (1<<8)-1),
+           'h': (-1<<15, (1<<15)-1), 'H': (0, (1<<16)-1),
+           'i': (-1<<31, (1<<31)-1), 'I': (0, (1<<32)-1),
+           'l': (-1<<31, (1<<31)-1), 'L': (0, (1<<32)-1)}
+
+def _compute(records, class_, names, function):
+    """Compute new values of fields of all records as function(*fields),
+    where fields are the old values of the named fields. Returns the
+    new columns, for _store(). Raises ValueError if any value doesn't
+    fit in its field."""
+    if numpy is not None:
+        columns = function(*[_column(records, n) for n in names])
+        columns = [numpy.asarray(c).astype(numpy.int64) for c in columns]
+    else:
+        rows = [function(*[getattr(r, n) for n in names]) for r in records]
+        columns = [[int(v) for v in c] for c in zip(*rows)] or \
+            [[] for n in names]
+    formats = dict(class_._fields)
+    for name, column in zip(names, columns):
+        low, high = _limits[formats[name]]
+        if len(column) and (min(column) < low or max(column) > high):
+            raise ValueError, "%s %s out of range" % (class_.__name__, name)
+    return columns
+
+def _store(records, names, columns):
+    """Set fields of all records to columns made by _compute()"""
+    if isinstance(records, Records):
+        for name, column in zip(names, columns):
+            records.array[name] = column
+        return
+    if numpy is not None:
+        columns = [c.tolist() for c in columns]
+    for i, record in enumerate(records):
+        for name, column in zip(names, columns):
+            setattr(record, name, column[i])
+
+
 class MapEditor:
     """Doom map editor
 
@@ -91,35 +546,95 @@ class MapEditor:
         sidedefs      List containing Sidedef objects
         linedefs      List containing Linedef objects
         sectors       List containing Sector objects
-        things        List containing Thing objects"""
+        things        List containing Thing objects
+        columnar      True if the lists are Records arrays
+
+    In columnar mode, each of the lists is a Records object holding
+    the decoded lump in a NumPy array, instead of a list of record
+    objects. This needs much less memory and time for large maps.
+
+    When loading from lumps, each list (including segs and ssectors)
+    is decoded when it is first used. to_lumps() gives the original
+    lumps for the lists that have not changed, and only packs the
+    records that have changed in the others (see RecordList)."""
 
-    def __init__(self, from_lumps=None):
-        """Create new, optionally from a lump.lump group"""
+    columnar = False
+
+    # Record lists, the lumps they are stored in and their record classes
+    _collections = [("vertexes", "VERTEXES", Vertex),
+                    ("sidedefs", "SIDEDEFS", Sidedef),
+                    ("linedefs", "LINEDEFS", Linedef),
+                    ("sectors",  "SECTORS",  Sector),
+                    ("things",   "THINGS",   Thing),
+                    ("segs",     "SEGS",     Seg),
+                    ("ssectors", "SSECTORS", SubSector)]
+
+    # Name -> (record class, lump) for lists not decoded yet
+    _undecoded = {}
+
+    def __init__(self, from_lumps=None, columnar=False):
+        """Create new, optionally from a lump.lump group. If columnar
+        is true, the records are kept in NumPy arrays."""
+        if columnar and numpy is None:
+            raise ImportError, "Columnar mode requires NumPy"
+        self.columnar = columnar
         if from_lumps is not None:
             self.from_lumps(from_lumps)
         else:
-            self.vertexes = []
-            self.sidedefs = []
-            self.linedefs = []
-            self.sectors  = []
-            self.things   = []
-            self.segs     = []
-            self.ssectors = []
+            self.vertexes = self._unpack_lump(Vertex,    "")
+            self.sidedefs = self._unpack_lump(Sidedef,   "")
+            self.linedefs = self._unpack_lump(Linedef,   "")
+            self.sectors  = self._unpack_lump(Sector,    "")
+            self.things   = self._unpack_lump(Thing,     "")
+            self.segs     = self._unpack_lump(Seg,       "")
+            self.ssectors = self._unpack_lump(SubSector, "")
 
     def _unpack_lump(self, class_, data):
-        s = class_._fmtsize
-        return [class_(bytes=data[i:i+s]) for i in xrange(0,len(data),s)]
+        if self.columnar:
+            return Records(class_, data)
+        return RecordList(class_, data)
+
+    def _pack_lump(self, class_, records):
+        if isinstance(records, (Records, RecordList)):
+            return records.tobytes()
+        return class_.pack_many(records)
+
+    def __getattr__(self, name):
+        # Decode a record list when it is first used
+        undecoded = self.__dict__.get('_undecoded')
+        if undecoded and name in undecoded:
+            class_, source = undecoded.pop(name)
+            records = self._unpack_lump(class_, source.data)
+            records.source = source
+            self.__dict__[name] = records
+            return records
+        raise AttributeError, name
+
+    def decode(self):
+        """Decode all record lists now, rather than when first used."""
+        for name, lumpname, class_ in self._collections:
+            getattr(self, name)
+
+    def _to_lump(self, name, class_):
+        """Return the lump for a record list"""
+        if name not in self.__dict__ and name in self._undecoded:
+            # Never used, so unchanged
+            return lump.Lump(self._undecoded[name][1])
+        records = getattr(self, name)
+        source = getattr(records, 'source', None)
+        if source is not None and not records.changed():
+            return lump.Lump(source)
+        return lump.Lump(self._pack_lump(class_, records))
 
     def from_lumps(self, lumpgroup):
-        """Load entries from a lump.lump group."""
+        """Load entries from a lump.lump group. The record lists are
+        decoded when they are first used."""
         m = lumpgroup
-        self.vertexes = self._unpack_lump(Vertex,    m["VERTEXES"].data)
-        self.sidedefs = self._unpack_lump(Sidedef,   m["SIDEDEFS"].data)
-        self.sectors  = self._unpack_lump(Sector,    m["SECTORS"].data)
-        self.things   = self._unpack_lump(Thing,     m["THINGS"].data)
-        self.linedefs = self._unpack_lump(Linedef,   m["LINEDEFS"].data)
-        self.ssectors = self._unpack_lump(SubSector, m["SSECTORS"].data)
-        self.segs     = self._unpack_lump(Seg,       m["SEGS"].data)
+        self._undecoded = {}
+        for name, lumpname, class_ in self._collections:
+            self.__dict__.pop(name, None)
+            # A copy of the lump, sharing the data without reading it
+            self._undecoded[name] = (class_, lump.Lump(m[lumpname]))
         self.blockmap = m["BLOCKMAP"]
         self.reject   = m["REJECT"]      # To be implemented
         self.nodes    = m["NODES"]
@@ -134,14 +649,14 @@ class MapEditor:
     def to_lumps(self):
         m = NameGroup()
         m["_HEADER_"] = lump.Lump("")
-        m["VERTEXES"] = lump.Lump("".join([x.pack() for x in self.vertexes]))
-        m["THINGS"  ] = lump.Lump("".join([x.pack() for x in self.things  ]))
-        m["LINEDEFS"] = lump.Lump("".join([x.pack() for x in self.linedefs]))
-        m["SIDEDEFS"] = lump.Lump("".join([x.pack() for x in self.sidedefs]))
-        m["SECTORS" ] = lump.Lump("".join([x.pack() for x in self.sectors ]))
+        m["VERTEXES"] = self._to_lump("vertexes", Vertex)
+        m["THINGS"  ] = self._to_lump("things", Thing)
+        m["LINEDEFS"] = self._to_lump("linedefs", Linedef)
+        m["SIDEDEFS"] = self._to_lump("sidedefs", Sidedef)
+        m["SECTORS" ] = self._to_lump("sectors", Sector)
         m["NODES"]    = self.nodes
-        m["SEGS"]     = lump.Lump("".join([x.pack() for x in self.segs    ]))
-        m["SSECTORS"] = lump.Lump("".join([x.pack() for x in self.ssectors]))
+        m["SEGS"]     = self._to_lump("segs", Seg)
+        m["SSECTORS"] = self._to_lump("ssectors", SubSector)
         m["BLOCKMAP"] = self.blockmap
         m["REJECT"]   = self.reject
         return m
@@ -175,6 +690,9 @@ class MapEditor:
         vlen = len(self.vertexes)
         ilen = len(self.sidedefs)
         slen = len(self.sectors)
+        if isinstance(self.vertexes, Records):
+            self._paste_columns(other, offset, vlen, ilen, slen)
+            return
         for vx in other.vertexes:
             x, y = vx.x, vx.y
             self.vertexes.append(Vertex(x+offset[0], y+offset[1]))
@@ -198,3 +716,176 @@ class MapEditor:
             z.y += offset[1]
             self.things.append(z)
 
+    def _paste_columns(self, other, offset, vlen, ilen, slen):
+        """paste() for columnar mode, adjusting the new rows in bulk"""
+        llen = len(self.linedefs)
+        tlen = len(self.things)
+        self.vertexes.extend(other.vertexes)
+        self.linedefs.extend(other.linedefs)
+        self.sidedefs.extend(other.sidedefs)
+        self.sectors.extend(other.sectors)
+        self.things.extend(other.things)
+        vertexes = self.vertexes.array[vlen:]
+        vertexes['x'] += offset[0]
+        vertexes['y'] += offset[1]
+        linedefs = self.linedefs.array[llen:]
+        linedefs['vx_a'] += vlen
+        linedefs['vx_b'] += vlen
+        for side in ('front', 'back'):
+            column = linedefs[side]
+            column[column != -1] += ilen
+        self.sidedefs.array[ilen:]['sector'] += slen
+        things = self.things.array[tlen:]
+        things['x'] += offset[0]
+        things['y'] += offset[1]
+
+    def transform(self, matrix):
+        """Apply an affine transformation to the map. The matrix is
+        ((a, b, dx), (c, d, dy)), which maps a point (x, y) to
+        (a*x + b*y + dx, c*x + d*y + dy); the translation column may be
+        left out. Coordinates are rounded to integers.
+
+        Nothing is changed if any resulting value doesn't fit in its
+        field; ValueError is raised instead.
+
+        Vertexes and things are moved and thing angles turned. If the
+        transformation mirrors the map, linedefs and segs are reversed
+        so that their front sides stay in front. Seg angles and offsets
+        are updated. NODES is updated if the transformation keeps
+        coordinates on the integer grid and bounding boxes aligned to
+        the axes (translation, mirroring, rotation by multiples of 90
+        degrees, integer scaling) and emptied otherwise. BLOCKMAP is
+        moved along by translations and emptied otherwise. Emptied
+        lumps have to be rebuilt with a node builder."""
+        (xx, xy, dx), (yx, yy, dy) = \
+            [tuple(row) + (0,) * (3 - len(row)) for row in matrix]
+        det = xx*yy - xy*yx
+        if not det:
+            raise ValueError, "Singular transformation matrix"
+        mirrored = det < 0
+
+        def points(x, y):
+            return _round(xx*x + xy*y + dx), _round(yx*x + yy*y + dy)
+
+        def turn(angle, halfturn):
+            # Turn angles, given in units of which halfturn make 180
+            # degrees, by the linear part of the transformation
+            t = angle * (math.pi / halfturn)
+            u, v = xx*_cos(t) + xy*_sin(t), yx*_cos(t) + yy*_sin(t)
+            return _atan2(v, u) * (halfturn / math.pi), _hypot(u, v)
+
+        def things(x, y, angle):
+            x, y = points(x, y)
+            return x, y, _round(turn(angle, 180.0)[0]) % 360
+
+        # Everything is computed and checked first, then stored
+        vertexes = _compute(self.vertexes, Vertex, ("x", "y"), points)
+        thingcolumns = _compute(self.things, Thing,
+            ("x", "y", "angle"), things)
+        vx, vy = vertexes
+        line_a = _column(self.linedefs, "vx_a")
+        line_b = _column(self.linedefs, "vx_b")
+        if mirrored:
+            line_a, line_b = line_b, line_a
+
+        def segs(vx_a, vx_b, angle, line, side, offset):
+            angle, factor = turn(angle, 32768.0)
+            if mirrored:
+                # Measure the offset again from the start of the side
+                vx_a, vx_b = vx_b, vx_a
+                angle += 32768
+                index = line & 0xFFFF
+                start = _where(side, line_b[index], line_a[index]) & 0xFFFF
+                offset = _hypot(vx[vx_a & 0xFFFF] - vx[start],
+                                vy[vx_a & 0xFFFF] - vy[start])
+            else:
+                offset = offset * factor
+            angle = (_round(angle) + 32768) % 65536 - 32768
+            return vx_a, vx_b, angle, line, side, _round(offset)
+
+        segnames = ("vx_a", "vx_b", "angle", "line", "side", "offset")
+        segcolumns = _compute(self.segs, Seg, segnames, segs)
+
+        nodes = getattr(self, "nodes", None)
+        if nodes is not None and nodes.data:
+            exact = (xy == yx == 0 or xx == yy == 0) and \
+                all(float(k).is_integer() for k in (xx, xy, yx, yy))
+            if exact:
+                nodes = lump.Lump(self._transform_nodes(
+                    nodes.data, points, (xx, xy, yx, yy), mirrored))
+            else:
+                nodes = lump.Lump("")
+
+        blockmap = getattr(self, "blockmap", None)
+        if blockmap is not None and blockmap.data:
+            if (xx, xy, yx, yy) == (1, 0, 0, 1):
+                data = blockmap.data
+                x = util.unpack16(data[0:2]) + int(_round(dx))
+                y = util.unpack16(data[2:4]) + int(_round(dy))
+                low, high = _limits['h']
+                if not (low <= x <= high and low <= y <= high):
+                    raise ValueError, "BLOCKMAP origin out of range"
+                blockmap = lump.Lump(util.pack16(x) + util.pack16(y) +
+                    data[4:])
+            else:
+                blockmap = lump.Lump("")
+
+        _store(self.vertexes, ("x", "y"), vertexes)
+        _store(self.things, ("x", "y", "angle"), thingcolumns)
+        if mirrored:
+            _store(self.linedefs, ("vx_a", "vx_b"), (line_a, line_b))
+        _store(self.segs, segnames, segcolumns)
+        if nodes is not None:
+            self.nodes = nodes
+        if blockmap is not None:
+            self.blockmap = blockmap
+
+    def _transform_nodes(self, data, points, linear, mirrored):
+        """Return NODES data transformed by transform()"""
+        xx, xy, yx, yy = linear
+        def box(top, bottom, left, right):
+            x1, y1 = points(left, top)
+            x2, y2 = points(right, bottom)
+            return (_maximum(y1, y2), _minimum(y1, y2),
+                    _minimum(x1, x2), _maximum(x1, x2))
+        def transform(*fields):
+            x, y = points(fields[0], fields[1])
+            ddx, ddy = fields[2:4]
+            ddx, ddy = xx*ddx + xy*ddy, yx*ddx + yy*ddy
+            rbox, lbox = box(*fields[4:8]), box(*fields[8:12])
+            right, left = fields[12:14]
+            if mirrored:
+                # What was right of the partition line is now left of it
+                rbox, lbox, right, left = lbox, rbox, left, right
+            return (x, y, ddx, ddy) + rbox + lbox + (right, left)
+        records = self._unpack_lump(Node, data)
+        names = [name for name, fmt in Node._fields]
+        _store(records, names, _compute(records, Node, names, transform))
+        return self._pack_lump(Node, records)
+
+    def translate(self, dx, dy):
+        """Move the map by (dx, dy)."""
+        self.transform(((1, 0, dx), (0, 1, dy)))
+
+    def rotate(self, angle, origin=(0, 0)):
+        """Rotate the map counterclockwise by an angle in degrees
+        around an origin point."""
+        if angle % 90 == 0:
+            # Exact, so that nodes are kept
+            c, s = [(1, 0), (0, 1), (-1, 0), (0, -1)][int(angle % 360) // 90]
+        else:
+            c, s = math.cos(math.radians(angle)), math.sin(math.radians(angle))
+        ox, oy = origin
+        self.transform(((c, -s, ox - c*ox + s*oy), (s, c, oy - s*ox - c*oy)))
+
+    def scale(self, sx, sy=None, origin=(0, 0)):
+        """Scale the map by sx horizontally and sy (by default, sx)
+        vertically, relative to an origin point."""
+        if sy is None:
+            sy = sx
+        ox, oy = origin
+        self.transform(((sx, 0, ox - sx*ox), (0, sy, oy - sy*oy)))
+
+    def mirror(self, x=True, y=False):
+        """Mirror the map, negating the x and/or y coordinates."""
+        self.transform(((x and -1 or 1, 0), (0, y and -1 or 1)))
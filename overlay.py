@@ -0,0 +1,178 @@
+"""
+    Layered access to a stack of WAD files, the way a source port sees
+    an IWAD with any number of PWADs loaded on top of it.
+"""
+
+import collections
+
+from omg import util
+from omg.wadio import WadIO
+from omg.wad import defstruct, MarkerGroup, HeaderGroup
+
+class Overlay:
+    """A read-only view of several WAD files stacked on top of each
+    other. Looking up a lump gives the entry from the last file that
+    has it, so later files override earlier ones.
+
+    Initialization:
+    o = Overlay([sources, structure])
+
+    Sources is a sequence of paths to WAD files or WadIO objects, the
+    IWAD first. Files given by path are opened read-only. More files
+    can be stacked on top with add().
+
+    Lumps are looked up by name within a namespace. Lumps between
+    marker lumps belong to the namespace of the section, e.g. 'sprites'
+    for lumps between S_START and S_END, and only override lumps in the
+    same namespace. Other lumps are in the global namespace (None).
+    Maps are replaced as a whole: a map in a later file hides all lumps
+    of the same map in earlier files. The sections and maps recognized
+    follow the MarkerGroup and HeaderGroup definitions of the structure
+    (by default, that of the WAD class).
+
+    All names are indexed when a file is added, using only its
+    directory. Lump data is read when it is asked for.
+
+    Member data:
+        .layers        List of WadIO objects, bottom to top"""
+
+    def __init__(self, sources=(), structure=defstruct):
+        self.layers = []
+        self._own = []
+        self._sections = [(d[1], d[3]) for d in structure \
+            if issubclass(d[0], MarkerGroup)]
+        self._maptypes = [d[3] for d in structure \
+            if issubclass(d[0], HeaderGroup)]
+        # namespace -> {name: (layer, index)}
+        self._index = {None: {}}
+        for namespace, prefix in self._sections:
+            self._index[namespace] = {}
+        # map name -> (layer, header index, [(lump name, index), ...])
+        self._maps = {}
+        for source in sources:
+            self.add(source)
+
+    def add(self, source):
+        """Stack a WAD file on top of the others. `source` may be a
+        path or a WadIO object. Returns the WadIO object."""
+        if isinstance(source, WadIO):
+            w = source
+        elif isinstance(source, str):
+            w = WadIO(source, readonly=True)
+            self._own.append(w)
+        else:
+            raise TypeError, "Expected WadIO or file path string"
+        layer = len(self.layers)
+        self.layers.append(w)
+        names = w._names()
+        # Namespace of each entry; False for markers and map lumps
+        spaces = [None] * len(names)
+        for namespace, prefix in self._sections:
+            for start, end in w.sections(prefix):
+                for i in xrange(start, min(end + 1, len(names))):
+                    if spaces[i] is None:
+                        spaces[i] = namespace
+                spaces[start] = False
+                if end < len(names):
+                    spaces[end] = False
+        for headers, tail in self._maptypes:
+            isheader = util.wccompile(headers)
+            istail = util.wccompile(tail)
+            i = 0
+            while i < len(names):
+                if spaces[i] is None and isheader(names[i]):
+                    header = i
+                    spaces[i] = False
+                    lumps = []
+                    i += 1
+                    while i < len(names) and spaces[i] is None and \
+                            istail(names[i]):
+                        lumps.append((names[i], i))
+                        spaces[i] = False
+                        i += 1
+                    self._maps[names[header]] = (layer, header, lumps)
+                else:
+                    i += 1
+        for i, name in enumerate(names):
+            namespace = spaces[i]
+            if namespace is False:
+                continue
+            # Nested markers (e.g. S1_START) inside sections are empty
+            if namespace is not None and not w._extent(i)[1]:
+                continue
+            self._index[namespace][name] = (layer, i)
+        return w
+
+    def namespaces(self):
+        """Return a list of the namespaces, None (global) first."""
+        return [None] + [namespace for namespace, prefix in self._sections]
+
+    def lookup(self, name, namespace=None):
+        """Return a (WadIO object, index) tuple for the entry that a
+        name resolves to, or raise LookupError."""
+        try:
+            layer, index = self._index[namespace][name]
+        except KeyError:
+            raise LookupError, name
+        return self.layers[layer], index
+
+    def locate(self, name, namespace=None):
+        """Return a (file name, position, size) tuple telling where
+        the data of a lump is found."""
+        w, index = self.lookup(name, namespace)
+        ptr, size = w._extent(index)
+        return w.basefile.name, ptr, size
+
+    def read(self, name, namespace=None, view=False):
+        """Read the data of the lump a name resolves to. See
+        WadIO.read() for the meaning of `view`."""
+        w, index = self.lookup(name, namespace)
+        return w.read(index, view)
+
+    def names(self, namespace=None):
+        """Return a sorted list of the lump names in a namespace."""
+        return sorted(self._index[namespace])
+
+    def find(self, pattern, namespace=None):
+        """Return a sorted list of the lump names in a namespace that
+        match a pattern (supporting wildcards)."""
+        match = util.wccompile(pattern)
+        return sorted(name for name in self._index[namespace] if match(name))
+
+    def __contains__(self, name):
+        return name in self._index[None]
+
+    def maps(self):
+        """Return a sorted list of the names of all maps."""
+        return sorted(self._maps)
+
+    def lookup_map(self, name):
+        """Return a (WadIO object, header index, [(lump name, index),
+        ...]) tuple for the file that a map resolves to, or raise
+        LookupError."""
+        try:
+            layer, header, lumps = self._maps[name]
+        except KeyError:
+            raise LookupError, name
+        return self.layers[layer], header, lumps
+
+    def read_map(self, name):
+        """Read all lumps of a map. Returns an ordered dict mapping lump
+        names (THINGS, LINEDEFS, etc) to data."""
+        w, header, lumps = self.lookup_map(name)
+        data = collections.OrderedDict()
+        for lumpname, index in lumps:
+            data[lumpname] = w.read(index)
+        return data
+
+    def close(self):
+        """Close the files that were opened by this object."""
+        for w in self._own:
+            w.close()
+        self._own = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -42,6 +42,10 @@ class Textures(collections.OrderedDict):
         if len(args):
             self.from_lumps(*args)
 
+    def __reduce__(self):
+        # OrderedDict's would pass the items to __init__
+        return self.__class__, (), None, None, self.iteritems()
+
     def from_lumps(self, *args):
         """Load texture definitions from a TEXTURE1/2 lump and its
         associated PNAMES lump, or a lump group containing the lumps."""
@@ -3,9 +3,11 @@
     by other Omgifol modules.
 """
 
-import fnmatch
+import os, sys, fnmatch, re
 
-from struct  import pack, unpack, calcsize
+from copy    import copy, deepcopy
+
+from struct  import pack, unpack, calcsize, Struct as _Struct
 
 _pack = pack
 _unpack = unpack
@@ -40,7 +42,176 @@ def writefile(target, data):
         target.write(data)
 
 def inwclist(elem, seq):
-    return any(fnmatch.fnmatchcase(elem, x) for x in seq)
+    return wccompile(seq)(elem) is not None
+
+_BLOCKSIZE = 1 << 20
+
+_copy_file_range = getattr(os, 'copy_file_range', None)
+_sendfile = getattr(os, 'sendfile', None)
+
+def _kernel_copy(infd, outfd, src_pos, dst_pos, size, chunk):
+    """Copy data between file descriptors without passing it through
+    Python. Returns the number of bytes copied, which is less than
+    `size` if the files or the platform don't support it."""
+    copied = 0
+    try:
+        while copied < size:
+            n = min(size - copied, chunk)
+            if _copy_file_range:
+                n = _copy_file_range(infd, outfd, n,
+                    src_pos + copied, dst_pos + copied)
+            elif _sendfile:
+                os.lseek(outfd, dst_pos + copied, 0)
+                n = _sendfile(outfd, infd, src_pos + copied, n)
+            else:
+                break
+            if n <= 0:
+                break
+            copied += n
+    except (OSError, ValueError):
+        pass
+    return copied
+
+def copy_range(source, target, src_pos, dst_pos, size):
+    """Copy `size` bytes from position src_pos in the file object
+    `source` to dst_pos in the file object `target`. Source and target
+    may be the same file, provided that dst_pos <= src_pos. Where
+    possible, the copying is done by the kernel (os.copy_file_range
+    or os.sendfile), otherwise in large blocks."""
+    if source is target:
+        assert dst_pos <= src_pos
+        if dst_pos == src_pos:
+            return
+        # Copying within a file only works on pieces that don't
+        # overlap; don't bother if that makes them small
+        chunk = src_pos - dst_pos
+    else:
+        chunk = _BLOCKSIZE
+    source.flush()
+    target.flush()
+    if chunk >= _BLOCKSIZE:
+        copied = _kernel_copy(source.fileno(), target.fileno(),
+            src_pos, dst_pos, size, chunk)
+        # Also makes the file object drop any stale read buffer
+        target.flush()
+        src_pos += copied
+        dst_pos += copied
+        size -= copied
+    while size > 0:
+        source.seek(src_pos)
+        block = source.read(min(size, _BLOCKSIZE))
+        if not block:
+            break
+        target.seek(dst_pos)
+        target.write(block)
+        src_pos += len(block)
+        dst_pos += len(block)
+        size -= len(block)
+
+
+#----------------------------------------------------------------------
+#
+# Compiled wildcard patterns. These follow the same rules as
+# fnmatch.fnmatchcase, but compiled patterns are cached and a list of
+# patterns is combined into a single regular expression.
+#
+
+_wccache = {}
+_WCCACHE_MAX = 100
+
+def iswildcard(pattern):
+    """Return True if the string contains wildcard characters."""
+    return '*' in pattern or '?' in pattern or '[' in pattern
+
+def _wctranslate(pat):
+    """Translate a wildcard pattern to an (unanchored) regular
+    expression. Same as fnmatch.translate, minus the flags."""
+    i, n = 0, len(pat)
+    res = ''
+    while i < n:
+        c = pat[i]
+        i = i+1
+        if c == '*':
+            res = res + '.*'
+        elif c == '?':
+            res = res + '.'
+        elif c == '[':
+            j = i
+            if j < n and pat[j] == '!':
+                j = j+1
+            if j < n and pat[j] == ']':
+                j = j+1
+            while j < n and pat[j] != ']':
+                j = j+1
+            if j >= n:
+                res = res + '\\['
+            else:
+                stuff = pat[i:j].replace('\\', '\\\\')
+                i = j+1
+                if stuff[0] == '!':
+                    stuff = '^' + stuff[1:]
+                elif stuff[0] == '^':
+                    stuff = '\\' + stuff
+                res = '%s[%s]' % (res, stuff)
+        else:
+            res = res + re.escape(c)
+    return res
+
+def wccompile(patterns):
+    """Return a match function for a wildcard pattern, or a sequence
+    of patterns of which any may match. The function returns None if
+    a string doesn't match. Compiled patterns are cached."""
+    if isinstance(patterns, str):
+        key = patterns
+    else:
+        key = tuple(patterns)
+    try:
+        return _wccache[key]
+    except KeyError:
+        pass
+    if isinstance(patterns, str):
+        regex = _wctranslate(patterns)
+    else:
+        # An empty list never matches
+        regex = '|'.join('(?:%s)' % _wctranslate(p) for p in patterns) or '(?!)'
+    match = re.compile('(?:%s)\\Z' % regex, re.S).match
+    # Bounded like fnmatch's cache, for long-running programs
+    if len(_wccache) >= _WCCACHE_MAX:
+        _wccache.clear()
+    _wccache[key] = match
+    return match
+
+def wcclassify(pattern_lists):
+    """Return a function that tells which of several wildcard patterns
+    (or sequences of patterns) a string matches first. The function
+    returns the index of the first match, or None if there is none."""
+    alternatives = []
+    for i, patterns in enumerate(pattern_lists):
+        if isinstance(patterns, str):
+            patterns = [patterns]
+        regex = '|'.join('(?:%s)' % _wctranslate(p) for p in patterns) or '(?!)'
+        alternatives.append('(?P<p%i>(?:%s)\\Z)' % (i, regex))
+    match = re.compile('|'.join(alternatives) or '(?!)', re.S).match
+    def classify(string):
+        m = match(string)
+        if m is None:
+            return None
+        return int(m.lastgroup[1:])
+    return classify
+
+try:
+    _buffer = buffer
+except NameError:
+    _buffer = None
+
+def view(source, offset=0, size=None):
+    """Return a read-only view of `size` bytes starting at `offset` in
+    a string, mmap or other buffer object, without copying the data."""
+    if size is None:
+        size = len(source) - offset
+    if _buffer is not None:
+        return _buffer(source, offset, size)
+    return memoryview(source)[offset:offset+size]
 
 
 #----------------------------------------------------------------------
@@ -121,8 +292,10 @@ _struct_template = '''
 class Struct(object):
     """%(doc)s"""
 
+    __slots__ = %(slots)r
     _fmtsize = %(fmtsize)i
     _fmt  = %(fmt)r
+    _fields = %(fielddefs)r
 
     def __init__(self, %(initargs)s, bytes=None):
         if bytes:
@@ -134,12 +307,41 @@ class Struct(object):
     def __repr__(self):
         return %(reprexpr)s
 
-    def __getattribute__(self, name):
-        return object.__getattribute__(self, name)
-
     def pack(self):
         return %(packexpr)s
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in Struct.__slots__[:-1]:
+            if hasattr(self, name):
+                state[name] = getattr(self, name)
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.iteritems():
+            setattr(self, name, value)
+
+    @classmethod
+    def unpack_many(cls, data):
+        """Unpack a string or buffer of records stored back to back.
+        Returns a list of instances."""
+        %(defaults)s
+        new = object.__new__
+        records = []
+        append = records.append
+        for pos in xrange(0, len(data) - %(fmtsize)i + 1, %(fmtsize)i):
+            self = new(cls)
+            %(unpackmanyexpr)s
+            %(init_exec)s
+            append(self)
+        return records
+
+    @classmethod
+    def pack_many(cls, records):
+        """Pack a sequence of instances into a string of records
+        stored back to back."""
+        return "".join([%(packexpr)s for self in records])
+
 %(flagdefs)s
 
 Struct.__name__ = %(name)r
@@ -166,6 +368,7 @@ def _structdef(name, doc, fields, flags=None, init_exec=""):
     fields = [f for f in fields if f[1] != 'x']
 
     fmt = "<" + ("".join(f[1] for f in fields))
+    fielddefs = tuple((f[0], f[1]) for f in fields)
     fmtsize = calcsize(fmt)
 
     # properties for easy access to the 'flags' bit field
@@ -182,24 +385,38 @@ def _structdef(name, doc, fields, flags=None, init_exec=""):
     # example:  x=0, y=0, foo="BAR"
     initargs = ', '.join(f[0] + "=" + repr(f[2]) for f in fields+extra)
 
-    # example:  self.x, self.y, self.foo = unpack('hh8s', bytes);
-    #           self.foo = zstrip(safe_name(self.foo))
-    unpackexpr =  ', '.join('self.'+f[0] for f in fields)
-    unpackexpr += (" = unpack(%r, bytes); " % fmt)
-    unpackexpr += "; ".join("self.%s=zstrip(safe_name(self.%s))" % \
+    # Instances only have room for the fields, the extras and whatever
+    # init_exec sets; anything else goes in a __dict__ made on demand
+    slots = [f[0] for f in fields+extra]
+    for a in re.findall(r"\bself\.(\w+)\s*=[^=]", init_exec):
+        if a not in slots:
+            slots.append(a)
+    slots = tuple(slots) + ('__dict__',)
+
+    # example:  self.x, self.y, self.foo = _unpack_struct(bytes);
+    #           self.foo = fixname(self.foo[:8])
+    fixups = "".join("; self.%s=fixname(self.%s[:8])" % \
         (f[0], f[0]) for f in fields if 's' in f[1])
+    unpacked = ', '.join('self.'+f[0] for f in fields)
+    unpackexpr = unpacked + " = _unpack_struct(bytes)" + fixups
+    unpackmanyexpr = unpacked + " = _unpack_struct_from(data, pos)" + fixups
+
+    # unpack_many() runs init_exec too, with the arguments at their
+    # defaults as they are when unpacking in __init__
+    defaults = "; ".join("%s=%r" % (f[0], f[2]) for f in fields+extra)
 
     # example:  self.x=x; self.y=y; self.foo=foo
     initbody = "; ".join("self.%s=%s" % (f[0], f[0]) for f in fields)
 
-    # example:  pack()
+    # example:  _pack_struct(self.x, self.y, safe_name(self.foo))
+    # (string fields are padded with zeros by the format itself)
     packs = []
     for f in fields:
         if 's' in f[1]:
-            packs.append("zpad(safe_name(self.%s))" % f[0])
+            packs.append("safe_name(self.%s)" % f[0])
         else:
             packs.append("self.%s" % f[0])
-    packexpr = ("pack(%r, " % fmt) + ', '.join(packs) + ")"
+    packexpr = "_pack_struct(" + ', '.join(packs) + ")"
 
     reprexpr = '"<%s>(%s)" %% (%s)' % (name, " ".join("%s:%%s" % f[0] for f in fields), ", ".join("self.%s" % f[0] for f in fields))
 
@@ -208,9 +425,19 @@ def _structdef(name, doc, fields, flags=None, init_exec=""):
     #print s
 
     # print s.replace("Struct", name)
-    return compile(s, "<struct>", "exec")
+    return compile(s, "<struct>", "exec"), fmt
 
 def make_struct(*args, **kwargs):
     """Create a Struct class according to the given format"""
-    exec _structdef(*args, **kwargs)
+    code, fmt = _structdef(*args, **kwargs)
+    # The generated methods see the precompiled format as globals
+    compiled = _Struct(fmt)
+    namespace = dict(globals())
+    namespace['_unpack_struct'] = compiled.unpack
+    namespace['_unpack_struct_from'] = compiled.unpack_from
+    namespace['_pack_struct'] = compiled.pack
+    exec code in namespace
+    Struct = namespace['Struct']
+    # Let pickle find the class in the module that assigns it
+    Struct.__module__ = sys._getframe(1).f_globals.get('__name__', __name__)
     return Struct
\ No newline at end of file
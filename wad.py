@@ -1,7 +1,40 @@
 import os, glob, collections, fnmatch
 
 from omg import lump, util, palette
-from omg.wadio import WadIO
+from omg.wadio import WadIO, Entry
+
+def _save_lumps(wadio, items, inplace=None):
+    """Insert lumps, given as (name, lump) pairs, into a WadIO object;
+    None stands for an empty lump. Unchanged lumps whose data is not
+    in memory (loaded lazily, or dropped by a LumpCache) are copied
+    straight from the file they came from, without reading their data;
+    lumps held in memory are written from there. Entries for lumps loaded from the WadIO
+    object `inplace`, which must be open on the same file, refer to
+    the existing data."""
+    batch, source = [], None
+    for name, l in items:
+        origin = l.origin if l is not None else None
+        if origin and origin[0] is inplace:
+            if batch:
+                wadio.insert_copies(source, batch)
+                batch = []
+            wadio.entries.append(Entry(origin[1], origin[2], name))
+            continue
+        if origin and (origin[0] is wadio or origin[0].basefile is None \
+                or l._data is not None):
+            origin = None
+        if batch and (not origin or origin[0] is not source):
+            wadio.insert_copies(source, batch)
+            batch = []
+        if l is None:
+            wadio.insert(name, '')
+        elif not origin:
+            wadio.insert(name, l.data)
+        else:
+            source = origin[0]
+            batch.append((name, origin[1], origin[2]))
+    if batch:
+        wadio.insert_copies(source, batch)
 
 class LumpGroup(collections.OrderedDict):
     """A dict-like object for holding a group of lumps"""
@@ -20,13 +53,23 @@ class LumpGroup(collections.OrderedDict):
         """Load entries from a WAD file. All lumps from the same
         section in that WAD is loaded (e.g. if this is a patch
         section, all patches in the WAD will be loaded."""
-        iw = WAD(); iw.load(filename)
-        self._lumps += util.deepcopy(iw.__dict__[self._sect_name]._lumps)
+        iw = WAD(filename)
+        # The lumps belong to no other WAD, so there is no need to copy
+        self.update(iw.__dict__[self._name])
+
+    def _load_lump(self, wadio, i, lazy=False):
+        """Create a lump holding the data of entry i of a WadIO object.
+        If `lazy` is set, the data is only read when accessed."""
+        ptr, size = wadio._extent(i)
+        l = self.lumptype()
+        l.from_wadio(wadio, ptr, size, lazy)
+        return l
 
     def to_file(self, filename):
         """Save group as a separate WAD file."""
         w = WadIO(filename)
         self.save_wadio(w)
+        w.save()
 
     def from_glob(self, globpattern):
         """Create lumps from files matching the glob pattern."""
@@ -36,11 +79,16 @@ class LumpGroup(collections.OrderedDict):
 
     def save_wadio(self, wadio):
         """Save to a WadIO object."""
-        for m in self:
-            wadio.insert(m, self[m].data)
+        _save_lumps(wadio, self._layout())
+
+    def _layout(self):
+        """Return the entries to save, as a list of (name, lump) pairs
+        with None for empty marker lumps."""
+        return self.items()
 
     def copy(self):
-        """Creates a deep copy."""
+        """Creates a copy, holding copies of the lumps. The copies share
+        their data with the original lumps until changed."""
         a = self.__class__(self._name, self.lumptype, self.config)
         for k in self:
             a[k] = self[k].copy()
@@ -62,9 +110,10 @@ class MarkerGroup(LumpGroup):
         # In case group opens with XX_ and ends with X_
         self.abssuffix = self.config + "_END"
 
-    def load_wadio(self, wadio):
+    def load_wadio(self, wadio, lazy=False):
         """Load all matching lumps that have not already
-        been flagged as read from the given WadIO object."""
+        been flagged as read from the given WadIO object.
+        If `lazy` is set, lump data is only read when accessed."""
         inside = False
         startedwith, endswith = "", ""
         for i in range(len(wadio.entries)):
@@ -77,7 +126,7 @@ class MarkerGroup(LumpGroup):
                     inside = False
                 else:
                     if wadio.entries[i].size != 0:
-                        self[name] = self.lumptype(wadio.read(i))
+                        self[name] = self._load_lump(wadio, i, lazy)
                 wadio.entries[i].been_read = True
             else:
                 # print name, self.prefix, fnmatch.fnmatchcase(name, self.prefix)
@@ -86,13 +135,11 @@ class MarkerGroup(LumpGroup):
                     inside = True
                     wadio.entries[i].been_read = True
 
-    def save_wadio(self, wadio):
-        """Save to a WadIO object."""
+    def _layout(self):
         if len(self) == 0:
-            return
-        wadio.insert(self.prefix.replace('*', ''), '')
-        LumpGroup.save_wadio(self, wadio)
-        wadio.insert(self.suffix.replace('*', ''), '')
+            return []
+        return [(self.prefix.replace('*', ''), None)] + self.items() + \
+            [(self.suffix.replace('*', ''), None)]
 
 
 class HeaderGroup(LumpGroup):
@@ -102,9 +149,10 @@ class HeaderGroup(LumpGroup):
         self.headers = self.config[0]
         self.tail = self.config[1]
 
-    def load_wadio(self, wadio):
+    def load_wadio(self, wadio, lazy=False):
         """Load all matching lumps that have not already
-        been flagged as read from the given WadIO object."""
+        been flagged as read from the given WadIO object.
+        If `lazy` is set, lump data is only read when accessed."""
         numlumps = len(wadio.entries)
         i = 0
         while i < numlumps:
@@ -121,20 +169,19 @@ class HeaderGroup(LumpGroup):
                     i += 1
                     while i < numlumps and util.inwclist(wadio.entries[i].name, self.tail):
                         self[name][wadio.entries[i].name] = \
-                            self.lumptype(wadio.read(i))
+                            self._load_lump(wadio, i, lazy)
                         wadio.entries[i].been_read = True
                         i += 1
             if not added:
                 i += 1
 
-    def save_wadio(self, wadio):
-        """Save to a WadIO object."""
+    def _layout(self):
+        layout = []
         for h in self:
             hs = self[h]
-            wadio.insert(h, "")
-            for t in self.tail:
-                if t in hs:
-                    wadio.insert(t, hs[t].data)
+            layout.append((h, None))
+            layout.extend((t, hs[t]) for t in self.tail if t in hs)
+        return layout
 
 
 class NameGroup(LumpGroup):
@@ -143,14 +190,15 @@ class NameGroup(LumpGroup):
     def __init2__(self):
         self.names = self.config
 
-    def load_wadio(self, wadio):
+    def load_wadio(self, wadio, lazy=False):
         """Load all matching lumps that have not already
-        been flagged as read from the given WadIO object."""
+        been flagged as read from the given WadIO object.
+        If `lazy` is set, lump data is only read when accessed."""
 
         for i, entry in ((i, e)
                 for (i, e) in enumerate(wadio.entries)
                 if not e.been_read and util.inwclist(e.name, self.names)):
-            self[entry.name] = self.lumptype(wadio.read(i))
+            self[entry.name] = self._load_lump(wadio, i, lazy)
             entry.been_read = True
 
 class TxdefGroup(NameGroup):
@@ -167,6 +215,112 @@ class TxdefGroup(NameGroup):
         NameGroup.save_wadio(self, wadio)
 
 
+#---------------------------------------------------------------------
+#
+# Loading all groups in a single pass over the directory.
+#
+
+class _Classifier:
+    """Assigns the entries of a WAD directory to a list of groups in a
+    single pass, with the same result as letting each group's
+    load_wadio() scan the directory in turn.
+
+    This works because each group only looks at entries in order, and
+    only cares whether groups before it have taken an entry, so all
+    groups can be stepped together, in order of priority. For an entry
+    outside any marker section or map, one combined pattern tells which
+    group takes it. The only look-ahead is that of HeaderGroup, which
+    takes the lumps following a map header whether or not they have
+    been taken already; that is kept as state, like being inside a
+    marker section."""
+
+    def __init__(self, groups):
+        self.groups = groups
+        patterns = []
+        for group in groups:
+            if isinstance(group, MarkerGroup):
+                patterns.append(group.prefix)
+            elif isinstance(group, HeaderGroup):
+                patterns.append(group.headers)
+            else:
+                patterns.append(group.names)
+        self.match = [util.wccompile(p) for p in patterns]
+        self.first = util.wcclassify(patterns)
+        self.tail = [isinstance(g, HeaderGroup) and util.wccompile(g.tail) \
+            for g in groups]
+
+    def classify(self, names, sizes, taken=None):
+        """Return, for each group, a list of the (name, index) pairs of
+        entries to load into it; for a HeaderGroup, a list of (name,
+        [(name, index), ...]) pairs for the maps. `taken` may give the
+        entries to skip, like the been_read flags of entries."""
+        groups = self.groups
+        found = [[] for g in groups]
+        # For each group currently inside a marker section, a match
+        # function for the end marker; for each group currently taking
+        # the lumps of a map, the list to add them to
+        state = [None] * len(groups)
+        active = []
+        for i, name in enumerate(names):
+            claimed = bool(taken and taken[i])
+            first = self.first(name)
+            if not active:
+                if claimed or first is None:
+                    continue
+                candidates = (first,)
+            elif first is None or first in active:
+                candidates = active
+            else:
+                candidates = sorted(active + [first])
+            for k in candidates:
+                group = groups[k]
+                current = state[k]
+                if isinstance(group, MarkerGroup):
+                    if claimed:
+                        current = None
+                    elif current is not None:
+                        if current(name):
+                            current = None
+                        elif sizes[i]:
+                            found[k].append((name, i))
+                        claimed = True
+                    elif self.match[k](name):
+                        # In case group opens with XX_ and ends with X_
+                        current = util.wccompile([name.replace("START", "END"),
+                            group.abssuffix])
+                        claimed = True
+                elif isinstance(group, HeaderGroup):
+                    if current is not None:
+                        if self.tail[k](name):
+                            current.append((name, i))
+                            claimed = True
+                            continue
+                        current = None
+                    if not claimed and self.match[k](name):
+                        current = []
+                        found[k].append((name, current))
+                        claimed = True
+                elif not claimed and self.match[k](name):
+                    found[k].append((name, i))
+                    claimed = True
+                if (current is None) != (state[k] is None):
+                    if current is None:
+                        active.remove(k)
+                    else:
+                        active.append(k)
+                        active.sort()
+                state[k] = current
+        return found
+
+def _classifiable(group):
+    """Return True if the group loads itself in the standard way."""
+    for cls in (MarkerGroup, HeaderGroup, NameGroup):
+        if isinstance(group, cls):
+            return getattr(type(group).load_wadio, 'im_func', None) is \
+                cls.load_wadio.im_func
+    return False
+
+
 #---------------------------------------------------------------------
 #
 # This defines the default structure for WAD files.
@@ -213,7 +367,7 @@ class WAD:
     the sections follows the structure specification.
 
     Initialization:
-    new = WAD([from_file, structure])
+    new = WAD([from_file, structure, lazy])
 
     Source may be a string representing a path to a file to load from.
     By default, an empty WAD is created.
@@ -221,13 +375,28 @@ class WAD:
     Structure may be used to specify a custom lump
     categorization/loading configuration.
 
+    If `lazy` is set, only the directory of the file is read when
+    loading; the data of each lump is read when it is first accessed.
+
+    If `max_resident_bytes` is given, the WAD is loaded lazily and the
+    data of unchanged lumps is kept within that many bytes: the least
+    recently used data is dropped from memory and read again from the
+    file when needed. Changed lumps stay in memory. The LumpCache
+    doing this, with counters for hits, misses and evictions, is the
+    .cache attribute (None if there is no budget).
+
+    A DiskCache (see the diskcache module) may be passed as
+    `parse_cache` to skip working out which group each lump belongs to
+    when the same file is loaded again.
+
     Member data:
         .structure     Structure definition.
         .palette       Palette (not implemented yet)
         .sprites, etc  Sections containing lumps, as specified by
                        the structure definition"""
 
-    def __init__(self, from_file=None, structure=defstruct):
+    def __init__(self, from_file=None, structure=defstruct, lazy=False,
+            max_resident_bytes=None, parse_cache=None):
         """Create a new WAD. The optional `source` argument may be a
         string specifying a path to a file or a WadIO object.
         If omitted, an empty WAD is created. A WADStructure object
@@ -238,44 +407,206 @@ class WAD:
         self.palette = palette.default
         self.structure = structure
         self.groups = []
+        self._classifier = None
+        # The WadIO object the WAD was loaded from, and the path of the
+        # file if the WAD opened it itself
+        self._wadio = None
+        self._path = None
+        if max_resident_bytes is not None:
+            self.cache = lump.LumpCache(max_resident_bytes)
+            lazy = True
+        else:
+            self.cache = None
         for group_def in self.structure:
             instance = group_def[0](*tuple(group_def[1:]))
             self.__dict__[group_def[1]] = instance
             self.groups.append(instance)
         if from_file:
-            self.from_file(from_file)
+            self.from_file(from_file, lazy, parse_cache)
 
-    def from_file(self, source):
+    def from_file(self, source, lazy=False, parse_cache=None):
         """Load contents from a file. `source` may be a string
-        specifying a path to a file or a WadIO object."""
+        specifying a path to a file or a WadIO object. If `lazy` is
+        set, lump data is not read until it is accessed, so the file
+        must be kept open and unchanged for as long as the lumps are
+        in use. Otherwise, a file given by path is closed again once
+        everything is read. If a DiskCache is given as `parse_cache`, the assignment of
+        lumps to groups is looked up there rather than worked out
+        again."""
         if isinstance(source, WadIO):
             w = source
+            self._path = None
         elif isinstance(source, str):
             assert os.path.exists(source)
-            w = WadIO(source)
+            w = WadIO(source, readonly=True)
+            self._path = source
         else:
             raise TypeError, "Expected WadIO or file path string"
+        self._wadio = w
+        try:
+            self._load(w, lazy, parse_cache)
+        finally:
+            # All lump data is in memory now, so the file needn't be
+            # held open
+            if not lazy and w is not source:
+                w.close()
+        self._track()
+
+    def _load(self, w, lazy, parse_cache):
+        """Fill the groups from an open WadIO object."""
+        if not all(_classifiable(group) for group in self.groups):
+            for group in self.groups:
+                group.load_wadio(w, lazy)
+            return
+        if self._classifier is None:
+            self._classifier = _Classifier(self.groups)
+        if w._entries is not None:
+            taken = [entry.been_read for entry in w.entries]
+        else:
+            taken = None
+        def classify():
+            return self._classifier.classify(w._names(), w._extents()[1], taken)
+        if parse_cache is not None and taken is None and w.issafe:
+            found = parse_cache.get(w.basefile.name,
+                ('classify', repr(self.structure)), classify)
+        else:
+            found = classify()
+        # Create the lumps in the order their data is found in the file
+        ptrs = w._extents()[0]
+        needed = []
+        for k, group in enumerate(self.groups):
+            if isinstance(group, HeaderGroup):
+                for name, items in found[k]:
+                    needed.extend((ptrs[i], k, i) for lumpname, i in items)
+            else:
+                needed.extend((ptrs[i], k, i) for name, i in found[k])
+        needed.sort()
+        lumps = {}
+        for ptr, k, i in needed:
+            lumps[k, i] = self.groups[k]._load_lump(w, i, lazy)
+        for k, group in enumerate(self.groups):
+            if isinstance(group, HeaderGroup):
+                for name, items in found[k]:
+                    group[name] = NameGroup()
+                    for lumpname, i in items:
+                        group[name][lumpname] = lumps[k, i]
+            else:
+                for name, i in found[k]:
+                    group[name] = lumps[k, i]
+
+    def _lumps(self):
+        """Iterate over all lumps in all groups."""
         for group in self.groups:
-            group.load_wadio(w)
+            for l in group.itervalues():
+                if isinstance(l, LumpGroup):
+                    for m in l.itervalues():
+                        yield m
+                else:
+                    yield l
 
-    def to_file(self, filename):
+    def _track(self):
+        """Attach all lumps to the cache, if there is one."""
+        if self.cache is None:
+            return
+        for l in self._lumps():
+            l._cache = self.cache
+            if l._data is not None and l.origin is not None:
+                self.cache.add(l)
+
+    def to_file(self, filename, dedup=False):
         """Save contents to a WAD file. Caution: if a file with the given name
         already exists, it will be overwritten. However, the existing file will
         be kept as <filename>.tmp until the operation has finished, to stay safe
-        in case of failure."""
+        in case of failure. If `dedup` is set, lumps with identical data
+        share a single copy of it in the file.
+
+        Unchanged lumps whose data hasn't been read yet (with lazy
+        loading) are copied directly from the file they came from,
+        which must still exist and be unchanged."""
         use_backup = os.path.exists(filename)
         tmpfilename = filename + ".tmp"
         if use_backup:
             if os.path.exists(tmpfilename):
                 os.remove(tmpfilename)
             os.rename(filename, tmpfilename)
-        w = WadIO(filename)
+        w = WadIO(filename, dedup=dedup)
         for group in write_order:
             self.__dict__[group].save_wadio(w)
         w.save()
         if use_backup:
             os.remove(tmpfilename)
 
+    def save_incremental(self, compact_threshold=None):
+        """Save changes back to the file the WAD was loaded from, in
+        place. Only lumps that have changed since they were loaded (or
+        last saved) are written, followed by a new directory; the data
+        of other lumps is left where it is. The changes are made in a
+        transaction (see WadIO), so the file is never left half-saved.
+
+        Space used by replaced lumps is reused when possible, otherwise
+        left unused. The file is never compacted here, since that moves
+        data that lazily loaded lumps (and copies of them) may still
+        refer to. Instead, if a fraction `compact_threshold` is given,
+        returns True when more than that fraction of the file is unused
+        afterwards, meaning that compacting it (e.g. by saving it anew
+        with to_file()) is advisable; otherwise returns False.
+
+        A WAD loaded eagerly from a path opens the file again for
+        this, which must not have been changed by other means since.
+        Other WAD objects loaded lazily from the same file must not be
+        used afterwards."""
+        source = self._wadio
+        if source is not None and source.basefile is not None:
+            path = source.basefile.name
+        else:
+            path = self._path
+        if path is None:
+            raise IOError, "the WAD was not loaded from an open file"
+        # An eagerly loaded WAD closed its file after reading it
+        reopen = source.basefile is None
+        layout = []
+        for group in write_order:
+            layout.extend(self.__dict__[group]._layout())
+        clean = [l is None or (l.origin is not None and \
+            l.origin[0] is source) for name, l in layout]
+        if all(clean):
+            # Nothing to do if the directory is the same, too
+            current = zip(source._names(), *source._extents())
+            if len(current) == len(layout) and all(l is None or \
+                    (name, l.origin[1], l.origin[2]) == current[i] \
+                    for i, (name, l) in enumerate(layout)):
+                if not reopen:
+                    return self._wasteful(source, compact_threshold)
+                w = WadIO(path, readonly=True)
+                try:
+                    return self._wasteful(w, compact_threshold)
+                finally:
+                    w.close()
+        if reopen or source.readonly:
+            w = WadIO(path)
+        else:
+            w = source
+        try:
+            with w.transaction():
+                w.entries = []
+                _save_lumps(w, layout, inplace=source)
+            # The lumps now refer to the updated file
+            for entry, (name, l) in zip(w.entries, layout):
+                if l is not None:
+                    l.origin = (w, entry.ptr, entry.size)
+            self._wadio = w
+            self._track()
+            return self._wasteful(w, compact_threshold)
+        finally:
+            if reopen:
+                w.close()
+
+    def _wasteful(self, wadio, threshold):
+        """Tell if more than a fraction of a file is unused"""
+        if threshold is None:
+            return False
+        return wadio.calc_waste()[0] > threshold * wadio._end()
+
     def __add__(self, other):
         assert isinstance(other, WAD)
         w = WAD(structure=self.structure)
@@ -285,4 +616,77 @@ class WAD:
         return w
 
     def copy(self):
-        return util.deepcopy(self)
+        """Create a copy of the WAD. Lump data is shared with the
+        original until changed, so a copy costs little memory."""
+        w = WAD(structure=self.structure)
+        w.palette = self.palette
+        # The copied lumps are attached to the same cache
+        w.cache = self.cache
+        w.groups = []
+        for group_def in self.structure:
+            name = group_def[1]
+            group = self.__dict__[name].copy()
+            w.__dict__[name] = group
+            w.groups.append(group)
+        return w
+
+
+def _resolve(policy, group, name, old, new):
+    """Decide which of two items with the same name to keep when
+    merging, according to a merge policy."""
+    if policy == 'last':
+        return new
+    if policy == 'first':
+        return old
+    if policy == 'error':
+        raise ValueError, "%s: %s appears more than once" % (group, name)
+    return policy(group, name, old, new)
+
+def merge(sources, filename=None, policy='last', structure=defstruct):
+    """Merge several WADs into one, in a single pass over the inputs.
+    Returns the merged WAD, and saves it if `filename` is given.
+
+    Sources may be paths to WAD files, WadIO objects or WAD objects.
+    Files are loaded lazily, so lump data is only read if needed; when
+    saving, lumps are copied straight from the input files. The lumps
+    of WAD objects are shared with the merged WAD, not copied.
+
+    When several inputs have an item with the same name in the same
+    group (e.g. a map or a sprite), `policy` decides which is kept:
+    'last' (the default) keeps the last, 'first' the first and 'error'
+    raises ValueError. It may also be a function taking the group name,
+    the item name and the old and new items, returning the item to
+    keep. Texture definitions in TEXTURE1/TEXTURE2 and PNAMES are
+    merged per texture, following the same policy, and encoded once
+    at the end."""
+    from omg import txdef
+    result = WAD(structure=structure)
+    textures = []
+    for source in sources:
+        if not isinstance(source, WAD):
+            source = WAD(source, structure=structure, lazy=True)
+        for group in result.groups:
+            other = source.__dict__[group._name]
+            if isinstance(group, TxdefGroup):
+                if 'PNAMES' in other:
+                    textures.append(other)
+                continue
+            for name, item in other.iteritems():
+                if name in group:
+                    item = _resolve(policy, group._name, name, group[name], item)
+                group[name] = item
+    txdefs = [group for group in result.groups if isinstance(group, TxdefGroup)]
+    if txdefs and len(textures) == 1:
+        txdefs[0].update(textures[0])
+    elif txdefs and textures:
+        merged = txdef.Textures()
+        for group in textures:
+            for name, texture in txdef.Textures(group).iteritems():
+                if name in merged:
+                    texture = _resolve(policy, txdefs[0]._name, name,
+                        merged[name], texture)
+                merged[name] = texture
+        txdefs[0].update(merged.to_lumps())
+    if filename is not None:
+        result.to_file(filename)
+    return result
@@ -1,7 +1,13 @@
-import os, md5, time, fnmatch
+import os, md5, time, bisect, mmap, contextlib, hashlib
 
 from omg import util
 
+# NumPy is optional; it speeds up handling of large directories
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 Header = util.make_struct(
   "Header",
   """Class for WAD file headers""",
@@ -20,6 +26,26 @@ Entry = util.make_struct(
 )
 
 
+def _parse_directory(data):
+    """Decode a WAD directory in one go. Returns a (positions, sizes,
+    names) tuple of columns; the first two are NumPy arrays if NumPy
+    is available, otherwise lists."""
+    count = len(data) // Entry._fmtsize
+    data = data[:count*Entry._fmtsize]
+    if numpy is not None:
+        table = numpy.frombuffer(data, numpy.dtype([('ptr', '<i4'),
+            ('size', '<i4'), ('name', 'S8')]))
+        ptrs = table['ptr'].astype(numpy.int64)
+        sizes = table['size'].astype(numpy.int64)
+    else:
+        fields = util.unpack('<' + 'll8s'*count, data)
+        ptrs = list(fields[0::3])
+        sizes = list(fields[1::3])
+    names = [util.zstrip(util.safe_name(data[i:i+8])) \
+        for i in xrange(8, len(data), Entry._fmtsize)]
+    return ptrs, sizes, names
+
+
 # WadIO.open() behaves just like open(). Sometimes it is
 # useful to specifically either open an existing file
 # or create a new one.
@@ -37,7 +63,92 @@ def create_wad(location):
     return WadIO(location)
 
 
-class WadIO:
+class _FreeList:
+    """Keeps track of unused regions ("holes") in a file, and hands out
+    space from them using best fit. Adjacent holes are merged."""
+
+    def __init__(self, holes=()):
+        self.bysize = []    # Sorted list of (size, start) tuples
+        self.starts = {}    # start -> end
+        self.ends = {}      # end -> start
+        for start, end in holes:
+            self.free(start, end)
+
+    def _add(self, start, end):
+        bisect.insort(self.bysize, (end - start, start))
+        self.starts[start] = end
+        self.ends[end] = start
+
+    def _remove(self, start, end):
+        del self.bysize[bisect.bisect_left(self.bysize, (end - start, start))]
+        del self.starts[start]
+        del self.ends[end]
+
+    def free(self, start, end):
+        """Mark the region from start to end as unused."""
+        if end <= start:
+            return
+        if end in self.starts:
+            following = self.starts[end]
+            self._remove(end, following)
+            end = following
+        if start in self.ends:
+            preceding = self.ends[start]
+            self._remove(preceding, start)
+            start = preceding
+        self._add(start, end)
+
+    def alloc(self, size):
+        """Take `size` bytes from the smallest hole that can hold them
+        and return the position, or None if no hole is big enough."""
+        i = bisect.bisect_left(self.bysize, (size, -1))
+        if i == len(self.bysize):
+            return None
+        holesize, start = self.bysize[i]
+        self._remove(start, start + holesize)
+        self._add(start + size, start + holesize)
+        return start
+
+    def take_end(self, end):
+        """If there is a hole ending at the given position, remove it
+        and return its start, otherwise return None."""
+        start = self.ends.get(end)
+        if start is not None:
+            self._remove(start, end)
+        return start
+
+
+class _Transaction:
+    """State of a transaction in progress on a WadIO object"""
+
+    def __init__(self, wadio, filesize):
+        self.header = wadio.header.pack()
+        self.entries = [Entry(e.ptr, e.size, e.name) for e in wadio.entries]
+        self.filesize = filesize
+        # Appended data not yet written to the file, and the
+        # positions where it starts and ends
+        self.pending = []
+        self.pending_pos = filesize
+        self.end = filesize
+        # Regions no longer used, to be made available after commit
+        self.freed = []
+        # Set if .entries was replaced
+        self.stale = False
+
+# Positional reads, used by read-only WadIO objects. Not available
+# on all platforms
+_pread = getattr(os, 'pread', None)
+
+# Size of the buffer for appended data in a transaction
+_WRITE_BUFSIZE = 1 << 22
+
+# Largest block read by iter_lumps(), and largest unused region that
+# it reads through rather than skipping
+_READ_BLOCKSIZE = 1 << 22
+_READ_GAP = 1 << 16
+
+
+class WadIO(object):
     """A WadIO object is used to open a WAD file for direct
     reading and writing.
 
@@ -65,24 +176,102 @@ class WadIO:
     is that changes can't be undone (so back up first!) and that
     file content will get fragmented when you edit lumps (unused
     space will appear). To get rid of the wasted space, use the
-    rewrite() method (which rewrites the entire file)."""
+    compact() method (which moves lump data within the file) or the
+    rewrite() method (which rewrites the entire file).
 
-    def __init__(self, openfrom=None):
+    The amount of waste is limited by reusing space: new lumps, lumps
+    that grow and the directory are placed in the smallest unused
+    region they fit in, and are only appended to the end of the file
+    when no such region exists. The attribute .space_reused counts the
+    bytes that were written into reused space rather than appended.
+
+    If `use_mmap` is set, the file is memory mapped and lumps are
+    read directly from the mapping. read() can then hand out views
+    of the mapped file (pass view=True) instead of copying the data,
+    which makes repeated random access to a large file nearly free.
+    Writing works the same in both modes.
+
+    When a file is opened, the directory is decoded in bulk and kept
+    in columns; Entry objects are only created once .entries is
+    accessed. Looking up, reading and measuring waste don't need them.
+
+    Many changes can be grouped into a transaction:
+
+        with wadio.transaction():
+            wadio.insert(...)
+            ...
+
+    Within a transaction, appended data is buffered, lumps are never
+    overwritten in place and the directory is only written once, at
+    the end. A journal file (the WAD's name + ".journal") records the
+    original state of the file, so that if the program is interrupted,
+    the transaction is either completed or rolled back the next time
+    the file is opened. If an exception occurs inside the with block,
+    all changes are rolled back.
+
+    If `readonly` is set, an existing file is opened for reading only,
+    and lumps are read with os.pread, or from a memory map where
+    os.pread isn't available (or use_mmap is set). Neither uses the
+    file position, so a read-only WadIO may be shared by any number
+    of threads: read(), read_at(), get(), select(), find(),
+    multifind(), offset_order(), calc_waste() and info_text() can be
+    called concurrently without locking. No other WadIO object may be
+    used from more than one thread at a time.
+
+    If `dedup` is set, insert() and update() don't store data that is
+    identical to the data of an entry written earlier through the same
+    object; the new entry points to the existing copy instead (which
+    the WAD format allows). The attribute .space_deduplicated counts
+    the bytes saved this way."""
+
+    def __init__(self, openfrom=None, use_mmap=False, readonly=False,
+            dedup=False):
         self.basefile = None
         self.issafe = True
         self.header = Header()
-        self.entries = []
+        self._entries = []
+        self._columns = None
+        self.use_mmap = use_mmap or (readonly and _pread is None)
+        self.readonly = readonly
+        self._map = None
+        # Maps entry names to sorted lists of indices; built on demand
+        self._index = None
+        # Unused regions and the number of entries referring to each
+        # data position, see _freelist()
+        self._free = None
+        self._refs = None
+        self.space_reused = 0
+        self._txn = None
+        self.dedup = dedup
+        # (size, SHA-1) of data written in dedup mode -> position, and
+        # the reverse
+        self._digests = {}
+        self._digest_at = {}
+        self.space_deduplicated = 0
         if openfrom is not None:
             self.open(openfrom)
 
     def open(self, filename):
         """Open a WAD file, create a new file if none exists at the path."""
-        assert not self.entries
+        assert not self._count()
         if self.basefile:
             raise IOError, "The handle is already open"
+        self._index = None
+        self._free = None
+        self._refs = None
+        self._digests = {}
+        self._digest_at = {}
         # Open an existing WAD
-        if os.path.exists(filename):
-            self.basefile = open(filename, 'r+b')
+        if os.path.exists(filename) or self.readonly:
+            if self.readonly:
+                # A journal means that another process is writing to
+                # the file, but the directory in the header stays valid
+                self.basefile = open(filename, 'rb')
+            else:
+                self.basefile = open(filename, 'r+b')
+                if os.path.exists(self._journal_path()):
+                    self._recover()
+                    self.basefile.seek(0)
             filesize = os.stat(self.basefile.name)[6]
             self.header = h = Header(bytes=self.basefile.read(Header._fmtsize))
             if (not h.type in ("PWAD", "IWAD")) or filesize < 12:
@@ -90,8 +279,14 @@ class WadIO:
             if filesize < h.dir_ptr + h.dir_len*Entry._fmtsize:
                 raise IOError, "Invalid directory information in header."
             self.basefile.seek(h.dir_ptr)
-            self.entries = [Entry(bytes=self.basefile.read(Entry._fmtsize)) \
-                for i in range(h.dir_len)]
+            self._entries = None
+            self._columns = _parse_directory(
+                self.basefile.read(h.dir_len*Entry._fmtsize))
+            if self.readonly:
+                self._filesize = filesize
+                if self.use_mmap:
+                    self._map = mmap.mmap(self.basefile.fileno(), 0,
+                        access=mmap.ACCESS_READ)
         # Create new
         else:
             self.basefile = open(filename, 'w+b')
@@ -101,25 +296,105 @@ class WadIO:
     def close(self):
         """Close the base file"""
         assert self.basefile
+        if self._txn is not None:
+            raise IOError, "a transaction is in progress"
         # Unfortunately, a save can't be forced here.
         if not self.issafe:
             raise IOError, \
                 "closing a modified file may corrupt it. use save() first"
         self.basefile.close()
         self.basefile = None
+        # The map isn't closed explicitly, since views handed out by
+        # read() may still refer to it
+        self._map = None
+
+    def _get_entries(self):
+        if self._entries is None:
+            ptrs, sizes, names = self._columns
+            if numpy is not None:
+                ptrs, sizes = ptrs.tolist(), sizes.tolist()
+            self._entries = [Entry(p, s, n) for p, s, n in \
+                zip(ptrs, sizes, names)]
+            # Other threads may still be reading the columns
+            if not self.readonly:
+                self._columns = None
+        return self._entries
+
+    def _set_entries(self, entries):
+        self._entries = entries
+        self._columns = None
+        self._index = None
+        if self._txn is None:
+            self._free = None
+            self._refs = None
+        else:
+            # The data of the old entries must survive a rollback, so
+            # the free list can't be rebuilt until the commit
+            self._txn.stale = True
+
+    entries = property(_get_entries, _set_entries, doc=
+        """List of Entry objects, created on first access. A new list
+        may be assigned to replace the whole directory.""")
+
+    def _count(self):
+        """Return the number of entries."""
+        if self._entries is None:
+            return len(self._columns[2])
+        return len(self._entries)
+
+    def _names(self):
+        """Return a list of the names of all entries."""
+        if self._entries is None:
+            return self._columns[2]
+        return [entry.name for entry in self._entries]
+
+    def _extent(self, i):
+        """Return the (position, size) of the data of entry i."""
+        if self._entries is None:
+            return int(self._columns[0][i]), int(self._columns[1][i])
+        entry = self._entries[i]
+        return entry.ptr, entry.size
+
+    def _extents(self):
+        """Return the data positions and sizes of all entries as two
+        sequences (NumPy arrays if NumPy is available)."""
+        if self._entries is None:
+            return self._columns[0], self._columns[1]
+        ptrs = [entry.ptr for entry in self._entries]
+        sizes = [entry.size for entry in self._entries]
+        if numpy is not None:
+            return (numpy.array(ptrs, numpy.int64),
+                numpy.array(sizes, numpy.int64))
+        return ptrs, sizes
+
+    def offset_order(self):
+        """Return a list of entry indices sorted by the position of
+        the data in the file. Entries at the same position keep their
+        directory order."""
+        ptrs, sizes = self._extents()
+        if numpy is not None:
+            return numpy.argsort(ptrs, kind='mergesort').tolist()
+        return sorted(xrange(len(ptrs)), key=ptrs.__getitem__)
 
     def select(self, id):
         """Return a valid index from a proposed index or entry name, or
         raise LookupError in case of failure."""
         assert self.basefile
         if isinstance(id, int):
-            if id < len(self.entries):
+            if id < self._count():
                 return id
             raise LookupError
         elif isinstance(id, str):
-            for i in range(len(self.entries)):
-                if fnmatch.fnmatchcase(self.entries[i].name, id):
-                    return i
+            index = self._name_index()
+            if not util.iswildcard(id):
+                if id in index:
+                    return index[id][0]
+                raise LookupError
+            match = util.wccompile(id)
+            found = [indices[0] for name, indices in index.iteritems() \
+                if match(name)]
+            if found:
+                return min(found)
             raise LookupError
         raise TypeError
 
@@ -140,101 +415,639 @@ class WadIO:
         are supported."""
         assert self.basefile
         if start is None: start = 0
-        if end   is None: end   = len(self.entries)
-        return [i for i in range(start, end) if \
-                fnmatch.fnmatchcase(self.entries[i].name, id)]
+        if end   is None: end   = self._count()
+        index = self._name_index()
+        if not util.iswildcard(id):
+            found = index.get(id, [])
+        else:
+            match = util.wccompile(id)
+            found = []
+            for name, indices in index.iteritems():
+                if match(name):
+                    found.extend(indices)
+            found.sort()
+        return found[bisect.bisect_left(found, start): \
+                     bisect.bisect_left(found, end)]
 
-    def read(self, id):
-        """Read an entry and return the data as a binary string."""
+    def sections(self, prefix):
+        """Return the index ranges of the marker sections of one kind,
+        as a list of (start, end) tuples where start is the index of
+        the start marker and end that of the end marker (or the number
+        of entries, if the section isn't closed). For example, prefix
+        'S' finds sprite sections from S_START or SS_START to S_END or
+        SS_END."""
         assert self.basefile
-        id = self.select(id)
-        self.basefile.seek(self.entries[id].ptr)
-        return self.basefile.read(self.entries[id].size)
+        names = self._names()
+        opening = util.wccompile(prefix + '*_START')
+        found = []
+        i, n = 0, len(names)
+        while i < n:
+            if opening(names[i]):
+                # In case the section opens with XX_ and ends with X_
+                closing = (names[i].replace('START', 'END'), prefix + '_END')
+                j = i + 1
+                while j < n and names[j] not in closing:
+                    j += 1
+                found.append((i, j))
+                i = j
+            i += 1
+        return found
+
+    def _name_index(self):
+        """Return a dict mapping entry names to sorted lists of entry
+        indices. The index is kept up to date by insert(), remove() and
+        rename(); if .entries is modified directly, set ._index to None
+        to have it rebuilt."""
+        if self._index is None:
+            index = {}
+            for i, name in enumerate(self._names()):
+                if name in index:
+                    index[name].append(i)
+                else:
+                    index[name] = [i]
+            self._index = index
+        return self._index
+
+    def read(self, id, view=False):
+        """Read an entry and return the data as a binary string. If
+        `view` is set, a read-only buffer is returned instead; for a
+        memory mapped file, this refers directly to the mapping and
+        involves no copying at all."""
+        assert self.basefile
+        ptr, size = self._extent(self.select(id))
+        return self.read_at(ptr, size, view)
+
+    def read_at(self, pos, size, view=False):
+        """Read `size` bytes of data at the given position. See read()
+        for the meaning of `view`."""
+        assert self.basefile
+        if self._txn is not None and pos + size > self._txn.pending_pos:
+            self._flush_pending()
+        if self.use_mmap:
+            mapping = self._mapping(pos + size)
+            if view:
+                return util.view(mapping, pos, size)
+            return mapping[pos:pos+size]
+        if self.readonly:
+            data = _pread(self.basefile.fileno(), size, pos)
+        else:
+            self.basefile.seek(pos)
+            data = self.basefile.read(size)
+        if view:
+            return util.view(data)
+        return data
+
+    def iter_lumps(self, order='offset', pattern=None, section=None):
+        """Iterate over entries and their data, yielding (index, entry,
+        view) tuples, where view is a read-only buffer holding the data.
+        With order='offset' (the default), entries are visited in the
+        order their data is stored in the file, and neighbouring lumps
+        are read together in large blocks; with order='directory', in
+        directory order.
+
+        `pattern` (a wildcard pattern or a sequence of them) restricts
+        the entries to those with matching names; `section` to those
+        inside marker sections with the given prefix (see sections())."""
+        assert self.basefile
+        if order == 'offset':
+            indices = self.offset_order()
+        elif order == 'directory':
+            indices = range(self._count())
+        else:
+            raise ValueError, "order must be 'offset' or 'directory'"
+        if pattern is not None:
+            match = util.wccompile(pattern)
+            names = self._names()
+            indices = [i for i in indices if match(names[i])]
+        if section is not None:
+            inside = set()
+            for start, end in self.sections(section):
+                inside.update(xrange(start + 1, end))
+            indices = [i for i in indices if i in inside]
+        entries = self.entries
+        if self.use_mmap or order != 'offset':
+            for i in indices:
+                yield i, entries[i], self.read(i, view=True)
+            return
+        # Group lumps into blocks that are read in one go
+        i = 0
+        while i < len(indices):
+            start, size = self._extent(indices[i])
+            end = start + size
+            j = i + 1
+            while j < len(indices):
+                ptr, size = self._extent(indices[j])
+                if max(end, ptr + size) - start > _READ_BLOCKSIZE or \
+                        ptr - end > _READ_GAP:
+                    break
+                end = max(end, ptr + size)
+                j += 1
+            block = self.read_at(start, end - start)
+            for k in indices[i:j]:
+                ptr, size = self._extent(k)
+                yield k, entries[k], util.view(block, ptr - start, size)
+            i = j
+
+    def _mapping(self, end):
+        """Return a memory map of the base file covering at least the
+        first `end` bytes, remapping the file if it has grown."""
+        if not self.readonly:
+            # Make buffered writes visible through the map
+            self.basefile.flush()
+        if self._map is None or len(self._map) < end:
+            # As in close(), an outdated map is left for the garbage
+            # collector to unmap once no views refer to it anymore
+            self._map = mmap.mmap(self.basefile.fileno(), 0,
+                access=mmap.ACCESS_READ)
+        return self._map
 
     def remove(self, id):
         """Remove an entry."""
         assert self.basefile
-        del (self.entries[self.select(id)])
+        self._check_writable()
+        id = self.select(id)
+        entry = self.entries[id]
+        del (self.entries[id])
+        self._release(entry.ptr, entry.size)
+        # All following indices shift, so rebuild on the next lookup
+        self._index = None
+        self.issafe = False
 
     def rename(self, id, new):
         """Rename an entry."""
         assert self.basefile
-        self.entries[self.select(id)].name = new[0:8].upper()
+        self._check_writable()
+        id = self.select(id)
+        entry = self.entries[id]
+        new = new[0:8].upper()
+        if self._index is not None:
+            indices = self._index[entry.name]
+            indices.remove(id)
+            if not indices:
+                del self._index[entry.name]
+            bisect.insort(self._index.setdefault(new, []), id)
+        entry.name = new
         self.issafe = False
 
+    def _check_writable(self):
+        if self.readonly:
+            raise IOError, "the file is opened read-only"
+
     def write_at(self, pos, data):
         """Write data at the given position."""
+        self._check_writable()
+        txn = self._txn
+        if txn is not None and pos + len(data) > txn.pending_pos:
+            if pos == txn.end:
+                # Buffer data appended during a transaction
+                txn.pending.append(data)
+                txn.end += len(data)
+                if txn.end - txn.pending_pos >= _WRITE_BUFSIZE:
+                    self._flush_pending()
+                return
+            self._flush_pending()
+            txn.end = txn.pending_pos = max(txn.end, pos + len(data))
         self.basefile.seek(pos)
         self.basefile.write(data)
 
     def write_append(self, data):
         """Write data at the end of the file"""
+        self.write_at(self._end(), data)
+
+    def _end(self):
+        """Return the size of the file, including buffered data."""
+        if self._txn is not None:
+            return self._txn.end
+        if self.readonly:
+            return self._filesize
         self.basefile.seek(0, 2)
-        self.basefile.write(data)
+        return self.basefile.tell()
+
+    def _flush(self):
+        """Flush written data to the file, unless a transaction is
+        collecting it."""
+        if self._txn is None:
+            self.basefile.flush()
+
+    def _flush_pending(self):
+        """Write data buffered by a transaction to the file."""
+        txn = self._txn
+        if txn is None or not txn.pending:
+            return
+        self.basefile.seek(txn.pending_pos)
+        for data in txn.pending:
+            self.basefile.write(data)
+        txn.pending = []
+        txn.pending_pos = txn.end
 
     def insert(self, name, data, index=None):
         """Insert a new entry at the optional index (defaults to
         appending)."""
         assert self.basefile
+        self._check_writable()
         try:
             index = self.select(index)
         except:
             index = None
         self.issafe = False
-        self.basefile.seek(0, 2)
-        pos = self.basefile.tell()
-        self.basefile.write(data)
+        pos = self._store(data)
+        self._claim(pos, len(data))
         if index is None:
             self.entries.append(Entry(pos, len(data), name))
+            if self._index is not None:
+                self._index.setdefault(name, []).append(len(self.entries)-1)
         else:
             self.entries.insert(index, Entry(pos, len(data), name))
-        self.basefile.flush()
+            self._index = None
+        self._flush()
+
+    def insert_copies(self, source, items, index=None):
+        """Insert new entries with data copied from another WadIO
+        object, at the optional index (defaults to appending). `items`
+        is a sequence of (name, position, size) tuples telling where
+        the data of each entry is found in the source file. The data is
+        appended to the file without passing through Python where
+        possible; data that lies contiguously in the source file is
+        copied in one go."""
+        assert self.basefile and source.basefile
+        assert source is not self
+        self._check_writable()
+        try:
+            index = self.select(index)
+        except:
+            index = None
+        if self.dedup:
+            # The data is needed to recognize duplicates
+            for name, ptr, size in items:
+                self.insert(name, source.read_at(ptr, size), index)
+                if index is not None:
+                    index += 1
+            return
+        self.issafe = False
+        source._flush_pending()
+        self._flush_pending()
+        pos = self._end()
+        runs = []
+        entries = []
+        for name, ptr, size in items:
+            if runs and runs[-1][0] + runs[-1][2] == ptr:
+                runs[-1][2] += size
+            elif size:
+                runs.append([ptr, pos, size])
+            entries.append(Entry(pos, size, name))
+            self._claim(pos, size)
+            pos += size
+        for src_pos, dst_pos, size in runs:
+            util.copy_range(source.basefile, self.basefile, src_pos, dst_pos,
+                size)
+        if self._txn is not None:
+            self._txn.end = self._txn.pending_pos = pos
+        if index is None:
+            first = len(self.entries)
+            self.entries.extend(entries)
+            if self._index is not None:
+                for i, entry in enumerate(entries):
+                    self._index.setdefault(entry.name, []).append(first + i)
+        else:
+            self.entries[index:index] = entries
+            self._index = None
+        self._flush()
 
     def update(self, id, data):
         """Write new data for an existing lump. If the new data is
         bigger than what's present, a new position in the file will be
         allocated for the lump."""
         assert self.basefile
+        self._check_writable()
         id = self.select(id)
-        if len(data) != self.entries[id].size:
+        entry = self.entries[id]
+        if len(data) != entry.size:
             self.issafe = False
-        if len(data) <= self.entries[id].size:
-            self.write_at(self.entries[id].ptr, data)
+        self._freelist()
+        digest = self._digest(data)
+        shared = self._digests.get(digest)
+        if shared is not None and shared == entry.ptr and \
+                entry.size == len(data):
+            # Already refers to identical data
+            pass
+        # In a transaction, the old data must be kept for a rollback
+        elif shared is None and 0 < len(data) <= entry.size and \
+                self._refs.get(entry.ptr) == 1 and self._txn is None:
+            self._forget(entry.ptr)
+            self.write_at(entry.ptr, data)
+            self._release(entry.ptr + len(data), entry.size - len(data),
+                entry=False)
+            if digest is not None:
+                self._remember(digest, entry.ptr)
         else:
-            # Currently, the lump simply gets placed at the end of the file.
-            # Instead, calc_waste() could be used to find empty space
-            self.basefile.seek(0, 2)
-            self.entries[id].ptr = self.basefile.tell()
-            self.basefile.write(data)
-        self.entries[id].size = len(data)
-        self.basefile.flush()
+            # The data doesn't fit, or is shared with another entry
+            self._release(entry.ptr, entry.size)
+            entry.ptr = self._store(data, digest)
+            self._claim(entry.ptr, len(data))
+            self.issafe = False
+        entry.size = len(data)
+        self._flush()
+
+    def _digest(self, data):
+        """Return the key identifying data in dedup mode, or None."""
+        if self.dedup and len(data):
+            return len(data), hashlib.sha1(data).digest()
+        return None
+
+    def _remember(self, digest, ptr):
+        self._digests[digest] = ptr
+        self._digest_at[ptr] = digest
+
+    def _forget(self, ptr):
+        """Drop the dedup record for data that is about to change."""
+        digest = self._digest_at.pop(ptr, None)
+        if digest is not None:
+            del self._digests[digest]
+
+    def _store(self, data, digest=None):
+        """Write data for an entry and return its position. In dedup
+        mode, the position of an identical copy is returned if there
+        is one."""
+        if digest is None:
+            digest = self._digest(data)
+        if digest in self._digests:
+            self.space_deduplicated += len(data)
+            return self._digests[digest]
+        pos = self._allocate(len(data))
+        self.write_at(pos, data)
+        if digest is not None:
+            self._remember(digest, pos)
+        return pos
+
+    def _freelist(self):
+        """Return the list of unused regions in the file, building it
+        (and the entry reference counts) with calc_waste() first if
+        necessary."""
+        if self._free is None:
+            self.basefile.flush()
+            self._refs = refs = {}
+            overlap = False
+            end = 0
+            for entry in sorted(self.entries, key=lambda e: e.ptr):
+                if entry.size:
+                    if entry.ptr in refs:
+                        refs[entry.ptr] += 1
+                    else:
+                        refs[entry.ptr] = 1
+                        overlap = overlap or entry.ptr < end
+                    end = max(end, entry.ptr + entry.size)
+            self._overlap = overlap
+            self._free = _FreeList(self.calc_waste()[1])
+            for ptr in list(self._digest_at):
+                if ptr not in refs:
+                    self._forget(ptr)
+        return self._free
+
+    def _allocate(self, size):
+        """Return a position where `size` bytes of new data can be
+        written, preferring unused space inside the file."""
+        if not size:
+            return self._end()
+        free = self._freelist()
+        pos = free.alloc(size)
+        if pos is not None:
+            self.space_reused += size
+            return pos
+        end = self._end()
+        # A hole at the end of the file can be extended
+        pos = free.take_end(end)
+        if pos is not None:
+            self.space_reused += end - pos
+            return pos
+        return end
+
+    def _claim(self, ptr, size):
+        """Register an entry referring to data at the position."""
+        if size and self._refs is not None:
+            self._refs[ptr] = self._refs.get(ptr, 0) + 1
+
+    def _release(self, ptr, size, entry=True):
+        """Unregister an entry referring to the given data, and mark
+        the space unused if no other entry refers to it. With entry=False,
+        the space is simply marked unused."""
+        if not size or self._free is None:
+            return
+        if entry:
+            self._refs[ptr] -= 1
+            if self._refs[ptr]:
+                return
+            del self._refs[ptr]
+            self._forget(ptr)
+        if self._txn is not None:
+            # Still used by the directory in the file
+            self._txn.freed.append((ptr, size))
+        elif self._overlap:
+            # Entries point into each other's data; rather than
+            # figuring out what is still in use, rebuild the list
+            self._free = None
+        else:
+            self._free.free(ptr, ptr + size)
 
     def save(self):
         """Save directory and header changes to the WAD file."""
         assert self.basefile
-        if self.issafe: return
-        self.basefile.seek(0, 2)
-        endpos = self.basefile.tell()
+        # In a transaction, the directory is written by commit()
+        if self.issafe or self._txn is not None: return
+        self._write_directory()
+        self.issafe = True
+
+    def _write_directory(self, header_hook=None):
+        """Write the directory and point the header to it. If given,
+        header_hook is called with the new header (packed) after the
+        directory has been written but before the header is."""
+        olddir = self.header.dir_ptr, self.header.dir_len*Entry._fmtsize
+        directory = "".join(entry.pack() for entry in self.entries)
+        pos = self._allocate(len(directory))
+        self.write_at(pos, directory)
+        self.basefile.flush()
+        self.header.dir_len = len(self.entries)
+        self.header.dir_ptr = pos
+        if header_hook:
+            header_hook(self.header.pack())
+        self.write_at(0, self.header.pack())
+        self.basefile.flush()
+        # The old directory is garbage now that the header points to
+        # the new one
+        self._release(olddir[0], olddir[1], entry=False)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Return a context manager that runs a transaction: begin()
+        on entry, commit() on exit and rollback() on error."""
+        self.begin()
+        try:
+            yield self
+        except:
+            self.rollback()
+            raise
+        self.commit()
+
+    def begin(self):
+        """Start a transaction. Unsaved changes are saved first."""
+        assert self.basefile
+        self._check_writable()
+        if self._txn is not None:
+            raise IOError, "a transaction is already in progress"
+        self.save()
+        # Make sure the free list describes the file as it is now
+        self._freelist()
+        self.basefile.flush()
+        self._txn = _Transaction(self, self._end())
+        self._write_journal(self._txn.header + util.pack('<q', self._txn.filesize))
+
+    def commit(self):
+        """Finish a transaction: write buffered data and the directory
+        to the file and sync it to disk."""
+        txn = self._txn
+        assert txn is not None
+        self._flush_pending()
+        self._txn = None
+        def sync(header):
+            os.fsync(self.basefile.fileno())
+            # Record the new header, so that recovery can tell
+            # whether it made it to the file
+            self._write_journal(txn.header + \
+                util.pack('<q', txn.filesize) + header)
+        self._write_directory(sync)
+        self.basefile.flush()
+        os.fsync(self.basefile.fileno())
+        os.remove(self._journal_path())
+        if txn.stale:
+            self._free = None
+            self._refs = None
+        else:
+            for ptr, size in txn.freed:
+                self._release(ptr, size, entry=False)
+        self.issafe = True
+
+    def rollback(self):
+        """Abort a transaction, undoing all changes made since it
+        started."""
+        txn = self._txn
+        assert txn is not None
+        self._txn = None
+        self._restore(txn.header, txn.filesize)
+        os.remove(self._journal_path())
+        self.header = Header(bytes=txn.header)
+        self.entries = txn.entries
+        self._index = None
+        self._free = None
+        self._refs = None
+        self._digests = {}
+        self._digest_at = {}
+        self.issafe = True
+
+    def _journal_path(self):
+        return self.basefile.name + ".journal"
+
+    def _write_journal(self, data):
+        f = open(self._journal_path(), 'wb')
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+
+    def _restore(self, header, filesize):
+        """Put back the original header and size of the file."""
+        self.write_at(0, header)
+        self.basefile.flush()
+        # Reading the mapping beyond the new end of the file would crash
+        self._map = None
+        self.basefile.truncate(filesize)
+        os.fsync(self.basefile.fileno())
+
+    def _recover(self):
+        """Complete or roll back a transaction that was interrupted,
+        according to the journal."""
+        journal = open(self._journal_path(), 'rb').read()
+        # If the journal is incomplete, the file hasn't been touched
+        if len(journal) >= Header._fmtsize + 8:
+            header = journal[:Header._fmtsize]
+            filesize = util.unpack('<q', journal[Header._fmtsize:][:8])[0]
+            newheader = journal[Header._fmtsize + 8:]
+            self.basefile.seek(0)
+            # Unless the new header was written, roll back
+            if self.basefile.read(Header._fmtsize) != newheader:
+                self._restore(header, filesize)
+        os.remove(self._journal_path())
+
+    def compact(self):
+        """Remove all wasted space from the WAD file, in place. Lump
+        data following the first unused region is slid towards the
+        start of the file in large blocks, the directory is written
+        after it and the file is truncated. Unlike rewrite(), this
+        needs no extra disk space and keeps the order of the data.
+
+        Views previously returned by read() must not be used after
+        calling this method. If the operation is interrupted, the
+        file will be corrupt."""
+        assert self.basefile
+        self._check_writable()
+        assert self._txn is None
+        # Merge the data of all entries into blocks of used space
+        blocks = []
+        for ptr, size in sorted(set((e.ptr, e.size) \
+                for e in self.entries if e.size)):
+            if blocks and ptr <= blocks[-1][1]:
+                blocks[-1][1] = max(blocks[-1][1], ptr + size)
+            else:
+                blocks.append([ptr, ptr + size])
+        # Move the blocks down, remembering where each one went
+        starts, ends, newstarts = [], [], []
+        pos = Header._fmtsize
+        for start, end in blocks:
+            # Data overlapping the header is left where it is
+            newstart = min(start, pos)
+            util.copy_range(self.basefile, self.basefile,
+                start, newstart, end - start)
+            starts.append(start)
+            ends.append(end)
+            newstarts.append(newstart)
+            pos = max(pos, newstart + end - start)
+        def relocate(ptr):
+            i = bisect.bisect_right(starts, ptr) - 1
+            if i < 0:
+                return min(ptr, pos)
+            return newstarts[i] + min(ptr, ends[i]) - starts[i]
         for entry in self.entries:
-            self.basefile.write(entry.pack())
+            entry.ptr = relocate(entry.ptr)
+        digests = self._digests
+        self._digests = {}
+        self._digest_at = {}
+        for digest, ptr in digests.items():
+            self._remember(digest, relocate(ptr))
+        directory = "".join(entry.pack() for entry in self.entries)
+        self.write_at(pos, directory)
         self.header.dir_len = len(self.entries)
-        self.header.dir_ptr = endpos
+        self.header.dir_ptr = pos
         self.write_at(0, self.header.pack())
         self.basefile.flush()
+        # Reading the mapping beyond the new end of the file would crash
+        self._map = None
+        self.basefile.truncate(pos + len(directory))
+        self._free = None
+        self._refs = None
         self.issafe = True
 
     def rewrite(self):
         """Rewrite the entire WAD file. This removes all garbage
-        (wasted space) from the file."""
+        (wasted space) from the file. See also compact()."""
         assert self.basefile
+        self._check_writable()
+        assert self._txn is None
         fpath = self.basefile.name
         # Write to a temporary file and rename it when done
         # os.tmpnam works too, but gives a security warning
         tmppath = md5.md5(str(time.time())).hexdigest()[:8] + ".tmp"
         tmppath = os.path.join(os.path.dirname(fpath), tmppath)
         outwad = create_wad(tmppath)
-        for i in range(len(self.entries)):
-            outwad.insert(self.entries[i].name, self.read(i))
+        for i, name in enumerate(self._names()):
+            outwad.insert(name, self.read(i))
         outwad.save()
         outwad.close()
         self.close()
@@ -249,26 +1062,38 @@ class WadIO:
         wasted space in the WAD and a list of (start, end) tuples for
         the spots where the wasted chunks are located."""
         assert self.basefile
-        filesize = os.stat(self.basefile.name)[6]
+        filesize = self._end()
+        ptrs, sizes = self._extents()
+        # Treat the header, the directory and the end of the file as
+        # chunks of used space, in addition to the lump data
+        fixed = [(0, 12), (filesize, filesize + 1),
+            (self.header.dir_ptr, self.header.dir_ptr + \
+                self.header.dir_len*Entry._fmtsize)]
+        if numpy is not None:
+            starts = numpy.concatenate(([c[0] for c in fixed], ptrs))
+            ends = numpy.concatenate(([c[1] for c in fixed], ptrs + sizes))
+            order = numpy.lexsort((ends, starts))
+            starts = starts[order]
+            # A chunk may lie within an earlier one, so compare with the
+            # furthest end so far
+            ends = numpy.maximum.accumulate(ends[order])
+            gaps = ends[:-1] < starts[1:]
+            positions = list(zip(ends[:-1][gaps].tolist(),
+                starts[1:][gaps].tolist()))
+            return sum(b - a for a, b in positions), positions
         # Create a list of (start, end) tuples to represent used space
-        chunks = []
-        # Treat the header and the end of the file as chunks of used space
-        chunks.append((0, 12))
-        chunks.append((filesize, filesize + 1))
-        # Add to the list the chunks that are occupied by lump data
-        chunks.append((self.header.dir_ptr, self.header.dir_ptr + \
-            len(self.entries)*Entry._fmtsize))
-        for entry in self.entries:
-            chunks.append((entry.ptr, entry.ptr + entry.size))
+        chunks = fixed + [(p, p + s) for p, s in zip(ptrs, sizes)]
         # Sort it so we can go through it linearly and check for gaps
         chunks.sort()
         positions = []
         space = 0
+        end = 0
         for i in range(0, len(chunks)-1):
-            # Check whether the end of the chunk touches the beginning of the
-            # next one. If not, there's wasted space between them.
-            if chunks[i][1] < chunks[i+1][0]:
-                positions.append((chunks[i][1], chunks[i+1][0]))
+            # Check whether the furthest end so far touches the beginning of
+            # the next chunk. If not, there's wasted space between them.
+            end = max(end, chunks[i][1])
+            if end < chunks[i+1][0]:
+                positions.append((end, chunks[i+1][0]))
                 space += positions[-1][1] - positions[-1][0]
         return space, positions
 
@@ -285,9 +1110,10 @@ class WadIO:
         s.append("Directory start: 0x%x" % self.header.dir_ptr)
         # List all the lumps and some relevant information
         s.append("\n\nEntries:\n\n     #  Name       Size       Position\n\n")
-        for i, entry in enumerate(self.entries):
+        for i, name in enumerate(self._names()):
+            ptr, size = self._extent(i)
             s.append("%6i  %s %s 0x%x\n" %
-                (i, entry.name.ljust(10), str(entry.size).ljust(10), entry.ptr))
+                (i, name.ljust(10), str(size).ljust(10), ptr))
         # Add info about wasted space in the WAD, to find out how much of an
         # improvement a rewrite() would make
         total, wasted = self.calc_waste()
@@ -295,4 +1121,125 @@ class WadIO:
         s.append("    %s bytes total\n" % str(total))
         for w in wasted:
             s.append("    %i bytes starting at 0x%x\n" % (w[1]-w[0], w[0]))
+        s.append("\n%i bytes written to reused space instead of appended\n" %
+            self.space_reused)
+        if self.dedup:
+            s.append("%i bytes not written thanks to deduplication\n" %
+                self.space_deduplicated)
         return "".join(s)
+
+
+class WadWriter(object):
+    """Writes a new WAD file from start to end, one lump at a time,
+    using a fixed amount of memory however big the file gets.
+
+    Initialization:
+    w = WadWriter(filename[, type])
+
+    Type is "PWAD" (the default) or "IWAD". An existing file is
+    overwritten. Lumps are added with add(), add_file() or add_many()
+    and their data is written in order through a large buffer; only
+    the directory is kept in memory. The directory and the header are
+    written by close(), which must be called for the file to be
+    valid. A WadWriter can be used in a with statement:
+
+        with WadWriter("out.wad") as w:
+            for name, data in generate():
+                w.add(name, data)
+
+    If the with block raises an exception, the unfinished file is
+    removed instead."""
+
+    def __init__(self, filename, type="PWAD", bufsize=_WRITE_BUFSIZE):
+        self.basefile = open(filename, 'wb')
+        self.header = Header(type=type)
+        self.bufsize = bufsize
+        self._directory = []
+        self._buffer = []
+        self._buffered = 0
+        self._pos = Header._fmtsize
+        self.basefile.write(self.header.pack())
+
+    def add(self, name, data):
+        """Add a lump with the given data, which may be a string or
+        any other object supporting the buffer interface."""
+        assert self.basefile
+        size = len(data)
+        self._directory.append(Entry(self._pos, size, name).pack())
+        self._pos += size
+        if size >= self.bufsize:
+            self._flush()
+            self.basefile.write(data)
+            return
+        self._buffer.append(data)
+        self._buffered += size
+        if self._buffered >= self.bufsize:
+            self._flush()
+
+    def add_file(self, name, source):
+        """Add a lump holding the contents of a file, given as a path
+        or a file object. The file is copied in large blocks, or by the
+        kernel where possible."""
+        assert self.basefile
+        if isinstance(source, str):
+            f = open(source, 'rb')
+        else:
+            f = source
+        try:
+            start = f.tell()
+            f.seek(0, 2)
+            size = f.tell() - start
+            self._flush()
+            util.copy_range(f, self.basefile, start, self._pos, size)
+            self.basefile.seek(0, 2)
+        finally:
+            if f is not source:
+                f.close()
+        self._directory.append(Entry(self._pos, size, name).pack())
+        self._pos += size
+
+    def add_many(self, items):
+        """Add lumps from an iterable, which may be a generator. Each
+        item is either a (name, data) pair or the path to a file; the
+        lump name is then made from the file name, as in
+        LumpGroup.from_glob."""
+        for item in items:
+            if isinstance(item, str):
+                name = os.path.basename(item)
+                if '.' in name:
+                    name = name[:name.rfind('.')]
+                self.add_file(util.fixname(name), item)
+            else:
+                self.add(*item)
+
+    def _flush(self):
+        if self._buffer:
+            for data in self._buffer:
+                self.basefile.write(data)
+            self._buffer = []
+            self._buffered = 0
+
+    def close(self):
+        """Write the directory and the header, and close the file."""
+        assert self.basefile
+        self._flush()
+        self.header.dir_len = len(self._directory)
+        self.header.dir_ptr = self._pos
+        self.basefile.write("".join(self._directory))
+        self.basefile.seek(0)
+        self.basefile.write(self.header.pack())
+        self.basefile.close()
+        self.basefile = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if exc_info[0] is None:
+            self.close()
+        elif self.basefile:
+            # The header written so far reads as a valid, empty WAD, so
+            # don't leave it behind
+            self.basefile.close()
+            os.remove(self.basefile.name)
+            self.basefile = None